@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+"""asyncio API for reading/writing Tombo *.chi / *.chs files, Python 3.6+ only
+(chi_io itself supports Python 2 so async code lives here).
+
+File I/O and decryption/encryption run in an executor, a chunk at a time,
+so the event loop is never blocked for longer than one chunk and callers
+can be cancelled between chunks.
+
+    plain_text = await chi_async.aread_encrypted_file(filename, password)
+    await chi_async.awrite_encrypted_file(filename, password, plain_text)
+
+All calls share chi_io's process wide key cache and (by default) a single
+thread pool, see set_default_executor().
+NOTE executors must be thread based, chunked decryption/encryption state
+is shared between calls.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import chi_io
+
+
+DEFAULT_CHUNK_SIZE = chi_io.DEFAULT_CHUNK_SIZE
+
+_get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)  # Python 3.6 has no get_running_loop(), get_event_loop() is equivalent in a coroutine
+
+_default_executor = None
+
+
+def set_default_executor(executor):
+    """Set the (thread based) executor used when one is not passed in, e.g.
+    concurrent.futures.ThreadPoolExecutor(max_workers=8).
+    None reverts to a shared ThreadPoolExecutor created on first use"""
+    global _default_executor
+    _default_executor = executor
+
+
+def get_default_executor():
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = ThreadPoolExecutor(thread_name_prefix='chi_async')
+    return _default_executor
+
+
+async def _run_in_executor(loop, executor, func, *args, on_cancel=None):
+    """loop.run_in_executor(), except that if cancelled it waits for func
+    (which can not be interrupted) to finish before re-raising CancelledError,
+    so callers can clean up (e.g. close files func is using) safely.
+    on_cancel - optional callable, called with the result of func if it completed
+        successfully but the caller was cancelled (e.g. to close a file func opened)
+    """
+    future = loop.run_in_executor(executor, func, *args)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        while not future.done():
+            try:
+                await asyncio.wait([future])
+            except asyncio.CancelledError:
+                pass  # still need to wait
+        if on_cancel is not None and not future.cancelled() and future.exception() is None:
+            on_cancel(future.result())
+        raise
+
+
+def _close(fileptr):
+    fileptr.close()
+
+
+def _read_and_feed(in_file, decoder, chunk_size):
+    """Executor work item, returns (number of bytes read, plaintext)"""
+    data = in_file.read(chunk_size)
+    if not data:
+        return 0, decoder.finish()
+    return len(data), decoder.feed(data)
+
+
+async def aiter_decrypt(filename, password, executor=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Async generator, decrypts a *.chi / *.chs file yielding plaintext bytes
+    as each chunk_size bytes of ciphertext are read and decrypted in executor.
+    Like chi_io.iter_decrypt() raises BadPassword at the end, i.e. plaintext
+    already yielded is NOT verified until the generator is exhausted.
+
+    progress - optional callable, called (in the event loop) with
+        (bytes processed, file size) after each chunk
+    """
+    loop = _get_running_loop()
+    executor = executor or get_default_executor()
+    decoder = await _run_in_executor(loop, executor, chi_io.ChiDecoder, password)  # key setup may be slow
+    in_file = await _run_in_executor(loop, executor, open, filename, 'rb', on_cancel=_close)
+    try:
+        file_size = os.fstat(in_file.fileno()).st_size
+        done = 0
+        while True:
+            read_len, plain_text = await _run_in_executor(loop, executor, _read_and_feed, in_file, decoder, chunk_size)
+            done += read_len
+            if progress is not None:
+                progress(done, file_size)
+            if plain_text:
+                yield plain_text
+            if not read_len:
+                break
+    except chi_io.BadPassword:
+        # do not dump out password as that could be a security hole
+        raise chi_io.BadPassword('Incorrect password for %r' % filename)
+    finally:
+        in_file.close()
+
+
+async def aread_encrypted_file(filename, password, executor=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Reads a *.chi / *.chs file without blocking the event loop, see chi_io.read_encrypted_file().
+    Returns bytes. Files no larger than chunk_size are read and decrypted
+    with a single executor call, larger files a chunk at a time (see aiter_decrypt())
+    so cancellation takes effect between chunks.
+
+    password is a (byte) string, i.e. not Unicode type, or a cipher from chi_io.CHI_cipher()
+    progress - optional callable, called with (bytes processed, file size) after each chunk
+    """
+    loop = _get_running_loop()
+    executor = executor or get_default_executor()
+    file_size = (await _run_in_executor(loop, executor, os.stat, filename)).st_size
+    if file_size <= chunk_size:
+        plain_text = await _run_in_executor(loop, executor, chi_io.read_encrypted_file, filename, password)
+        if progress is not None:
+            progress(file_size, file_size)
+        return plain_text
+    result = []
+    async for plain_text in aiter_decrypt(filename, password, executor=executor, chunk_size=chunk_size, progress=progress):
+        result.append(plain_text)
+    return b''.join(result)
+
+
+def _feed_and_write(out_file, encoder, plaintext, start, end):
+    out_file.write(encoder.feed(plaintext[start:end]))
+
+
+def _finish_and_close(out_file, encoder):
+    try:
+        out_file.write(encoder.finish())
+    finally:
+        out_file.close()
+
+
+async def awrite_encrypted_file(filename, password, plaintext, executor=None, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Writes a *.chi / *.chs file without blocking the event loop, see chi_io.write_encrypted_file().
+    plaintext is bytes, the md5 is calculated and then plaintext is encrypted
+    and written a chunk at a time in executor.
+    NOTE if cancelled (or on error) a partial file is left, caller is responsible for cleaning up.
+
+    password is a (byte) string, i.e. not Unicode type, or a cipher from chi_io.CHI_cipher()
+    progress - optional callable, called with (bytes processed, plaintext length) after each chunk
+    """
+    if not isinstance(plaintext, bytes):
+        raise chi_io.ChiIO('Only support 8-bit (binary/bytes) plaintext (got %r). Encode first, see help(codecs).' % type(plaintext))
+    loop = _get_running_loop()
+    executor = executor or get_default_executor()
+    plain_text_len = len(plaintext)
+    plain_text_md5sum = await _run_in_executor(loop, executor, lambda: chi_io.md5checksum(plaintext).digest())
+    encoder = await _run_in_executor(loop, executor, chi_io.ChiEncoder, password, plain_text_md5sum, plain_text_len)
+    out_file = await _run_in_executor(loop, executor, open, filename, 'wb', on_cancel=_close)
+    try:
+        for start in range(0, plain_text_len, chunk_size):
+            await _run_in_executor(loop, executor, _feed_and_write, out_file, encoder, plaintext, start, start + chunk_size)
+            if progress is not None:
+                progress(min(start + chunk_size, plain_text_len), plain_text_len)
+    except BaseException:
+        out_file.close()  # no executor call in flight, see _run_in_executor()
+        raise
+    await _run_in_executor(loop, executor, _finish_and_close, out_file, encoder)
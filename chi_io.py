@@ -49,12 +49,14 @@ TODO list
     *   most time spent in __round_func() - probably not much can be done
         there, however init of Blowfish is nearly 50% of a small decryption.
         If the same password is used for reading many files this is a large
-        overhead that could be reduced to 1 call!
+        overhead that could be reduced to 1 call! - DONE see KeyCache
 *   Some list, ord(), chr(), to string operations could be simplified to perform more operations whilst as lists before conversion back to strings
     *   use array module (array.array) instead of lists for performance
     *   Remove string operations, try and use cStringIO library instead to save on garbage collection and creating new items
 """
 
+import copy
+import mmap
 import os
 import sys
 
@@ -66,13 +68,46 @@ try:
     import hashlib
 
     md5checksum = hashlib.md5
+    sha256checksum = hashlib.sha256
 except ImportError:
     # pre 2.6/2.5
     import md5
 
     md5checksum = md5.new
-import string
-import random
+    sha256checksum = None  # not available, see PlainTextCache
+import tempfile
+import atexit
+import stat
+import io
+try:
+    from queue import Queue
+except ImportError:
+    # py2
+    from Queue import Queue
+import threading
+import time
+import warnings
+try:
+    from os import scandir
+except ImportError:
+    # py2 (without scandir backport), use os.walk()
+    scandir = None
+try:
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+except ImportError:
+    # py2 without futures backport
+    ProcessPoolExecutor = None
+try:
+    from multiprocessing import shared_memory  # Python 3.8+
+except ImportError:
+    shared_memory = None
+try:
+    from os import cpu_count
+except ImportError:
+    # py2
+    from multiprocessing import cpu_count
+from binascii import hexlify, unhexlify
+from collections import OrderedDict, namedtuple
 
 try:
     # raise ImportError
@@ -86,6 +121,45 @@ except ImportError:
         from io import BytesIO as FakeFile  # py3
 
 
+KEY_STATE_MAGIC = b'\x00CHIKS1\x00'  # prefix of export_key_state() results, has NUL bytes so will not be confused with a (typed) password
+KEY_STATE_SIZE = (18 + 4 * 256) * 4  # expanded Blowfish key; P array and S-boxes of 4 byte words
+
+
+class BlowfishCipherBase(object):
+    """Common code for the Blowfish backend wrappers, see TheBlowfishCipher()
+    Only implements export/import of key state (and pickle support)
+    """
+
+    def expanded_key(self):
+        """Returns the expanded key (18 P + 4*256 S words, big-endian) as bytes,
+        or None if the backend does not allow access to it"""
+        return None
+
+    def export_key_state(self):
+        """Returns bytes that CHI_cipher() accepts in place of a password.
+        Where the backend allows it the expanded key is included so that
+        the (slow) key schedule is skipped.
+        NOTE this is key material, treat it like a password
+        """
+        return KEY_STATE_MAGIC + self._password_key + (self.expanded_key() or b'')
+
+    def __reduce__(self):
+        # pickle support, e.g. for multiprocessing
+        return (CHI_cipher, (self.export_key_state(),))
+
+    def decrypt_cbc_into(self, data, iv, out):
+        """CBC decrypt data (any multiple of the 8 byte block size) writing
+        the result into writable buffer out (exactly len(data) bytes).
+        Backends without output buffer support decrypt to bytes and copy"""
+        out[:] = cbc_decrypt(self, data, iv)
+
+    def encrypt_cbc_into(self, data, iv, out):
+        """CBC encrypt data (any multiple of the 8 byte block size) writing
+        the result into writable buffer out (exactly len(data) bytes).
+        Backends without output buffer support encrypt to bytes and copy"""
+        out[:] = self.encrypt_cbc(data, iv)
+
+
 """
 Import pure python blowfish implementation
 this is from http://cheeseshop.python.org/pypi/pypwsafe/0.0.2
@@ -111,69 +185,232 @@ try:
     import Crypto
     from Crypto.Cipher import Blowfish
 
-    TheBlowfishCons = Blowfish.new
-    TheBlowfishClass = type(TheBlowfishCons(b'1234', mode=Blowfish.MODE_ECB))
-
-    def TheBlowfishCipher(password_bytes):
-        return TheBlowfishCons(password_bytes, mode=Blowfish.MODE_ECB)
-
-    # print('using PyCrypto')
-    implementation = 'using PyCrypto ' + Crypto.__version__
-    # TODO consider implementing support for pycryptodomex
-except BaseException:
-    try:
-        import blowfish  # https://github.com/jashandeep-sohi/python-blowfish - currently py3 only :-(
-
-        # TODO version number from blowfish
-        implementation = 'using blowfish(pure python)'
+    class PyCryptoBlowfish(BlowfishCipherBase):
+        """Implements ECB mode, along with (native) CBC mode encryption.
 
-        class PurePython3Blowfish:
-            """Only implements ECB mode"""
+        PyCryptodome/PyCrypto CBC mode objects run their own key schedule
+        (costing about as much as encrypting 10 blocks) and can not be given a
+        new IV, so the cached (expanded) ECB cipher can not be shared with them.
+        Short data is instead chained by hand with the ECB cipher; CBC encrypting
+        up to cbc_ecb_max_encrypt bytes (e.g. Tombo's salt and md5 blocks) and CBC
+        decrypting up to cbc_ecb_max_decrypt bytes (bulk ECB then one XOR) never
+        runs a key schedule, so encrypting a note costs at most one.
+        """
 
-            def __init__(self, password_key):
-                """password_key is byte type and must be between 4 and 56 bytes long."""
-                self.cipher = cipher = blowfish.Cipher(password_key)
+        cbc_ecb_max_encrypt = 64  # bytes, measured break even ~80 bytes
+        cbc_ecb_max_decrypt = 16 * 1024  # bytes, measured break even ~32Kb
+
+        def __init__(self, password_key, key_state=None):
+            """password_key is byte type and must be between 4 and 56 bytes long.
+            key_state is ignored, key schedule is native code (and is not exposed)"""
+            self._password_key = password_key  # needed to create CBC mode ciphers
+            self.cipher = Blowfish.new(password_key, Blowfish.MODE_ECB)
+
+        def decrypt(self, data_encrypted):
+            return self.cipher.decrypt(data_encrypted)
+
+        def encrypt(self, data):
+            return self.cipher.encrypt(data)
+
+        def _encrypt_cbc_blocks(self, data, iv):
+            """CBC encrypt a few blocks with the ECB cipher, no key schedule"""
+            if not isinstance(iv, bytes):
+                iv = memoryview(iv).tobytes()  # e.g. memoryview or bytearray
+            result = []
+            for offset in range(0, len(data), 8):
+                iv = self.cipher.encrypt(xor_bytes(data[offset:offset + 8], iv))
+                result.append(iv)
+            return b''.join(result)
+
+        def encrypt_cbc(self, data, iv):
+            """data may be any multiple of the (8 byte) block size"""
+            if len(data) <= self.cbc_ecb_max_encrypt:
+                return self._encrypt_cbc_blocks(data, iv)
+            return Blowfish.new(self._password_key, Blowfish.MODE_CBC, iv).encrypt(data)
 
-            def decrypt(self, data_encrypted):
-                data_decrypted = b"".join(self.cipher.decrypt_ecb(data_encrypted))
-                return data_decrypted
+    try:
+        # PyCryptodome can write into caller supplied buffers, PyCrypto can not
+        Blowfish.new(b'1234', Blowfish.MODE_ECB).decrypt(b'12345678', output=bytearray(8))
 
-            def encrypt(self, data):
-                data_encrypted = b"".join(self.cipher.encrypt_ecb(data))
-                return data_encrypted
+        def decrypt_cbc_into(self, data, iv, out):
+            if len(data) <= self.cbc_ecb_max_decrypt:
+                if len(data):
+                    out[:] = cbc_decrypt(self, data, iv)
+            else:
+                Blowfish.new(self._password_key, Blowfish.MODE_CBC, iv).decrypt(data, output=out)
 
-        TheBlowfishCons = PurePython3Blowfish
-        TheBlowfishClass = type(TheBlowfishCons(b'1234'))
+        def encrypt_cbc_into(self, data, iv, out):
+            if len(data) <= self.cbc_ecb_max_encrypt:
+                if len(data):
+                    out[:] = self._encrypt_cbc_blocks(data, iv)
+            else:
+                Blowfish.new(self._password_key, Blowfish.MODE_CBC, iv).encrypt(data, output=out)
 
-        def TheBlowfishCipher(password_bytes):
-            return TheBlowfishCons(password_bytes)
+        PyCryptoBlowfish.decrypt_cbc_into = decrypt_cbc_into
+        PyCryptoBlowfish.encrypt_cbc_into = encrypt_cbc_into
+        del decrypt_cbc_into, encrypt_cbc_into
+    except TypeError:
+        pass  # fall back to BlowfishCipherBase
 
-    except ImportError:
-        import pyblowfish  # built-in Pure Python 2 and 3 Blowfish from https://www.seanet.com/~bugbee/crypto/blowfish/ by Larry Bugbee
+    TheBlowfishCons = PyCryptoBlowfish
+    TheBlowfishClass = type(TheBlowfishCons(b'1234'))
 
-        # Fake version number from blowfish
-        implementation = 'using pyblowfish(pure python)'
+    def TheBlowfishCipher(password_bytes, key_state=None):
+        return TheBlowfishCons(password_bytes, key_state)
 
-        class PurePythonBlowfish:
-            """Only implements ECB mode"""
-
-            def __init__(self, password_key):
-                """password_key is byte type and must be between 4 and 56 bytes long."""
-                self.cipher = cipher = pyblowfish.Blowfish(password_key)
+    # print('using PyCrypto')
+    implementation = 'using PyCrypto ' + Crypto.__version__
+    # TODO consider implementing support for pycryptodomex
+except BaseException:
+    try:
+        if os.environ.get('NO_NUMPY'):
+            # disable NumPy via OS environment variable NO_NUMPY
+            raise ImportError
+        # https://numpy.org/ - not a crypto library, but ECB mode can be vectorized
+        import numpy
+        import pyblowfish  # used for key setup and (inherently serial) CBC encryption
+
+        implementation = 'using NumPy ' + numpy.__version__
+
+        class NumPyBlowfish(BlowfishCipherBase):
+            """Implements ECB mode vectorized with NumPy, each 8 byte block is a lane of the same array.
+            Mostly of benefit to (CBC) decryption; CBC encryption is serial so uses pyblowfish"""
+
+            def __init__(self, password_key, key_state=None):
+                """password_key is byte type and must be between 4 and 56 bytes long.
+                key_state is the (optional) expanded key for password_key, see expanded_key()"""
+                self._password_key = password_key
+                if key_state:
+                    self.cipher = cipher = pyblowfish.Blowfish.from_key_state(key_state)
+                else:
+                    self.cipher = cipher = pyblowfish.Blowfish(password_key)
+                self._P = [numpy.uint32(x) for x in cipher.P]
+                self._S = [numpy.array(x, dtype=numpy.uint32) for x in cipher.S]
+
+            def _ecb(self, data, P):
+                blocks = numpy.frombuffer(data, dtype='>u4').astype(numpy.uint32)  # native endian copy
+                xl = blocks[0::2]
+                xr = blocks[1::2]
+                S0, S1, S2, S3 = self._S
+                for i in range(16):
+                    xl ^= P[i]
+                    xr ^= ((S0[xl >> 24] + S1[(xl >> 16) & 0xFF]) ^ S2[(xl >> 8) & 0xFF]) + S3[xl & 0xFF]
+                    xl, xr = xr, xl
+                xl, xr = xr, xl
+                xr ^= P[16]
+                xl ^= P[17]
+                result = numpy.empty_like(blocks)
+                result[0::2] = xl
+                result[1::2] = xr
+                return result.astype('>u4').tobytes()
 
             def decrypt(self, data_encrypted):
-                data_decrypted = self.cipher.decipher_block(data_encrypted)
-                return data_decrypted
+                """data_encrypted may be any multiple of the (8 byte) block size"""
+                return self._ecb(data_encrypted, self._P[::-1])
 
             def encrypt(self, data):
-                data_encrypted = self.cipher.encipher_block(data)
-                return data_encrypted
+                """data may be any multiple of the (8 byte) block size"""
+                return self._ecb(data, self._P)
+
+            def encrypt_cbc(self, data, iv):
+                """data may be any multiple of the (8 byte) block size"""
+                return self.cipher.encrypt_cbc(data, iv)
 
-        TheBlowfishCons = PurePythonBlowfish
+            def expanded_key(self):
+                return self.cipher.export_key_state()
+
+        TheBlowfishCons = NumPyBlowfish
         TheBlowfishClass = type(TheBlowfishCons(b'1234'))
 
-        def TheBlowfishCipher(password_bytes):
-            return TheBlowfishCons(password_bytes)
+        def TheBlowfishCipher(password_bytes, key_state=None):
+            return TheBlowfishCons(password_bytes, key_state)
+
+    except ImportError:
+        try:
+            import blowfish  # https://github.com/jashandeep-sohi/python-blowfish - currently py3 only :-(
+
+            # TODO version number from blowfish
+            implementation = 'using blowfish(pure python)'
+
+            class PurePython3Blowfish(BlowfishCipherBase):
+                """Only implements ECB mode"""
+
+                def __init__(self, password_key, key_state=None):
+                    """password_key is byte type and must be between 4 and 56 bytes long.
+                    key_state is the (optional) expanded key for password_key, see expanded_key()"""
+                    self._password_key = password_key
+                    if key_state:
+                        # blowfish.Cipher has no API for this, relies on the P (pairs) and S attributes
+                        words = struct.unpack('>%dL' % (KEY_STATE_SIZE // 4), key_state)
+                        self.cipher = cipher = copy.copy(blowfish_template)
+                        cipher.P = tuple(zip(words[0:18:2], words[1:18:2]))
+                        cipher.S = tuple([tuple(words[18 + i * 256:18 + (i + 1) * 256]) for i in range(4)])
+                    else:
+                        self.cipher = cipher = blowfish.Cipher(password_key)
+
+                def decrypt(self, data_encrypted):
+                    data_decrypted = b"".join(self.cipher.decrypt_ecb(data_encrypted))
+                    return data_decrypted
+
+                def encrypt(self, data):
+                    data_encrypted = b"".join(self.cipher.encrypt_ecb(data))
+                    return data_encrypted
+
+                def encrypt_cbc(self, data, iv):
+                    """data may be any multiple of the (8 byte) block size"""
+                    return b"".join(self.cipher.encrypt_cbc(data, iv))
+
+                def expanded_key(self):
+                    words = [word for pair in self.cipher.P for word in pair]
+                    for box in self.cipher.S:
+                        words.extend(box)
+                    return struct.pack('>%dL' % len(words), *words)
+
+            blowfish_template = blowfish.Cipher(b'1234')  # copied when importing key state, saves creating structs
+            TheBlowfishCons = PurePython3Blowfish
+            TheBlowfishClass = type(TheBlowfishCons(b'1234'))
+
+            def TheBlowfishCipher(password_bytes, key_state=None):
+                return TheBlowfishCons(password_bytes, key_state)
+
+        except ImportError:
+            import pyblowfish  # built-in Pure Python 2 and 3 Blowfish from https://www.seanet.com/~bugbee/crypto/blowfish/ by Larry Bugbee
+
+            # Fake version number from blowfish
+            implementation = 'using pyblowfish(pure python)'
+
+            class PurePythonBlowfish(BlowfishCipherBase):
+                """Only implements ECB mode"""
+
+                def __init__(self, password_key, key_state=None):
+                    """password_key is byte type and must be between 4 and 56 bytes long.
+                    key_state is the (optional) expanded key for password_key, see expanded_key()"""
+                    self._password_key = password_key
+                    if key_state:
+                        self.cipher = cipher = pyblowfish.Blowfish.from_key_state(key_state)
+                    else:
+                        self.cipher = cipher = pyblowfish.Blowfish(password_key)
+
+                def decrypt(self, data_encrypted):
+                    """data_encrypted may be any multiple of the (8 byte) block size"""
+                    return self.cipher.decrypt_ecb(data_encrypted)
+
+                def encrypt(self, data):
+                    """data may be any multiple of the (8 byte) block size"""
+                    return self.cipher.encrypt_ecb(data)
+
+                def encrypt_cbc(self, data, iv):
+                    """data may be any multiple of the (8 byte) block size"""
+                    return self.cipher.encrypt_cbc(data, iv)
+
+                def expanded_key(self):
+                    return self.cipher.export_key_state()
+
+            TheBlowfishCons = PurePythonBlowfish
+            TheBlowfishClass = type(TheBlowfishCons(b'1234'))
+
+            def TheBlowfishCipher(password_bytes, key_state=None):
+                return TheBlowfishCons(password_bytes, key_state)
 
 if blowfish:
     implementation += ' ' + getattr(blowfish, '__version__', 'unknown version')
@@ -234,16 +471,204 @@ class UnsupportedFile(ChiIO):
     '''File not encrypted/not supported exception'''
 
 
-def gen_random_string(length_of_str):  # FIXME limited pool of bytes (originally for debugging purposes) 
-    """generate a string containing random characters of length length_of_str"""
-    source_set = string.ascii_letters + string.digits + string.punctuation
-    result = []
-    for x in range(length_of_str):
-        result.append(random.choice(source_set))
-    return ''.join(result).encode('us-ascii')  # convert (Unicode) string to bytes
+def _xor_bytes_py2(a, b):
+    """XOR two equal length byte strings, returns bytes"""
+    if not len(a):
+        return b''
+    x = long(hexlify(a), 16) ^ long(hexlify(b), 16)
+    return unhexlify('%0*x' % (len(a) * 2, x))
+
+
+def _xor_bytes_py3(a, b):
+    """XOR two equal length byte strings (or bytes-like objects), returns bytes"""
+    length = len(a)
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(length, 'big')
+
+if is_py3:
+    xor_bytes = _xor_bytes_py3
+else:
+    xor_bytes = _xor_bytes_py2
+
+
+if is_py3:
+    buffer_view = memoryview  # zero-copy slicing of bytes, bytearray, mmap
+else:
+    def buffer_view(data):
+        """memoryview() does not support all buffers (e.g. mmap) in py2 (or concatenation with str), slice as-is"""
+        if isinstance(data, memoryview):
+            return data.tobytes()
+        return data
+
+
+def release_view(view):
+    """Release view if it is a memoryview, so the underlying buffer (e.g. mmap)
+    can be closed even while an exception traceback still references it"""
+    release = getattr(view, 'release', None)  # py2 memoryview has no release()
+    if isinstance(view, memoryview) and release is not None:
+        release()
+
+
+CBC_IV = b'BLOWFISH'  # Tombo uses a fixed CBC IV/nonce
+CHI_EXTENSIONS = ('.chi', '.chs')
+
+
+def cbc_decrypt(cipher, enc_data, iv=CBC_IV):
+    """Blowfish-CBC decrypt enc_data (bytes, length must be a multiple of 8) using ECB cipher.
+    Returns bytes.
+
+    Unlike encryption, CBC decryption has no serial dependency; every
+    ciphertext block is ECB decrypted in a single (bulk) call into the
+    backend and then a single whole buffer XOR is performed against the
+    previous ciphertext blocks (IV for the first block). Speedup targets
+    compared with the old per-block (quadratic slicing) loop:
+
+      * PyCryptodome - linear rather than quadratic, target >= 100x for
+        multi-megabyte notes (2Mb note measured 25s -> 0.03s)
+      * blowfish (pure python) - target >= 1.5x, Blowfish rounds dominate
+      * pyblowfish (pure python) - target >= 1.4x, Blowfish rounds dominate
+    """
+    if not len(enc_data):
+        return b''
+    data = cipher.decrypt(enc_data)
+    if not isinstance(iv, bytes):
+        iv = memoryview(iv).tobytes()  # e.g. memoryview or bytearray
+    return xor_bytes(data, iv + enc_data[:-8])
+
+
+def encrypted_size(plain_text_len):
+    """Returns the size in bytes of a Tombo *.chi / *.chs file containing plain_text_len bytes of plaintext.
+    8 byte header, then 8 random bytes, 16 byte md5 and plaintext rounded up to the (8 byte) block size
+    """
+    return 8 + ((24 + plain_text_len + 7) // 8) * 8
+
+
+def encrypt_into_buffer(cipher, plain_text, out, salt=None):
+    """Tombo encrypt plain_text (bytes) into preallocated writable buffer out
+    (e.g. bytearray), which must be at least encrypted_size(len(plain_text))
+    bytes long. Returns the number of bytes written.
+
+    cipher is a Blowfish cipher, see CHI_cipher().
+    salt is the 8 random bytes prefixed to the data, generated if omitted.
+
+    All full blocks are encrypted with a single call into the backend's CBC mode.
+    The partial last block (if any) follows Tombo; the real bytes are XOR'd with
+    the previous ciphertext block, then padded (by repeating those XOR'd bytes)
+    and encrypted on their own.
+    """
+    plain_text_len = len(plain_text)
+    out_len = encrypted_size(plain_text_len)
+    if not is_py3 and isinstance(out, mmap.mmap):
+        # memoryview() does not support mmap in py2
+        buf = bytearray(out_len)
+        encrypt_into_buffer(cipher, plain_text, buf, salt=salt)
+        out[:out_len] = bytes(buf)
+        return out_len
+
+    m = md5checksum()
+    m.update(plain_text)
+    plain_text_md5sum = m.digest()
+
+    ## data that gets encrypted contains:
+    ##  8 bytes of random (if this is NOT random, then a plaintext+password will always create the SAME encrypted text)
+    ##  16 bytes of md5 of plaintext
+    ##  plain_text_len bytes of plaintext
+    ## the first 3 blocks are encrypted on their own, the plaintext is then
+    ## encrypted (continuing the CBC chain) straight from the callers buffer into out
+    tail_len = plain_text_len % 8
+    full_len = plain_text_len - tail_len
+    view = memoryview(plain_text)
+    out_view = memoryview(out)
+
+    out[0:4] = b'BF01'  # header, called version in tombo's CryptManager
+    struct.pack_into(FMT_STRUCT_4BYTE, out, 4, plain_text_len)  # 4 bytes - integer value containing unencrypted length of data
+    cipher.encrypt_cbc_into((salt or os.urandom(8)) + plain_text_md5sum, CBC_IV, out_view[8:32])
+    cipher.encrypt_cbc_into(view[:full_len], out_view[24:32], out_view[32:32 + full_len])
+    if tail_len:
+        # Tombo bit fiddling
+        # NOTE in Tombo the "fake" padding bytes at the end are not bit fiddled with
+        previous_block = out_view[24 + full_len:24 + full_len + tail_len]
+        tail = xor_bytes(view[full_len:], previous_block)
+        # pad the end few bytes so that blowfish can be applied
+        # just take "garbage" from the (bit fiddled) last few bytes
+        # NOTE this differs from Tombo which takes the garbage from the end of the previously encrypted block
+        tail = (tail * 8)[:8]
+        out_view[32 + full_len:out_len] = cipher.encrypt(tail)
+    return out_len
+
+
+def gen_random_string(length_of_str):
+    """Deprecated, use os.urandom(). Returns length_of_str random bytes"""
+    warnings.warn('gen_random_string() is deprecated, use os.urandom()', DeprecationWarning, stacklevel=2)
+    return os.urandom(length_of_str)
+
+
+class KeyCache(object):
+    """Thread safe cache of expanded (key schedule already run) Blowfish ciphers,
+    keyed on the md5 digest of the password (i.e. the Blowfish key), or
+    for imported expanded keys the entire key state, see CHI_cipher().
+    Used by CHI_cipher() so callers that pass in the same password for
+    every file only pay for the key schedule once.
+
+    max_entries - maximum number of ciphers held, least recently used are evicted first. 0 disables the cache
+    ttl - maximum age in seconds of an entry before it is discarded, None means no expiry
+
+    NOTE expanded keys are held in memory until evicted, expired or clear() is called.
+    """
+
+    def __init__(self, max_entries=16, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # md5key -> (timestamp, cipher)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, md5key):
+        """Returns cipher for md5key, or None if not present"""
+        with self._lock:
+            entry = self._entries.pop(md5key, None)
+            if entry is not None:
+                timestamp, cipher = entry
+                if self.ttl is None or _clock() - timestamp <= self.ttl:
+                    self._entries[md5key] = entry  # now most recently used
+                    self.hits += 1
+                    return cipher
+            self.misses += 1
+            return None
+
+    def put(self, md5key, cipher):
+        with self._lock:
+            if self.max_entries <= 0:
+                return
+            self._entries.pop(md5key, None)
+            self._entries[md5key] = (_clock(), cipher)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)  # least recently used
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns dict of hits, misses, evictions and (current) entries"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self._entries)}
+
+_clock = getattr(time, 'monotonic', time.time)  # py2 has no monotonic clock
+key_cache = KeyCache()
+
+
+def clear_key_cache():
+    """Discard all cached (expanded) keys, see KeyCache"""
+    key_cache.clear()
 
 
 def CHI_cipher(password):
+    """Returns Blowfish cipher for Tombo password.
+    password is a (byte) string, a cipher (returned as-is) or the result of export_key_state()
+    """
     if isinstance(password, TheBlowfishClass):
         cipher = password
     else:
@@ -253,13 +678,64 @@ def CHI_cipher(password):
             except UnicodeEncodeError:
                 raise ChiIO('Only support 8-bit (binary/bytes) password (got %r). Encode first, see help(codecs).' % type(password))
 
-        # Generate md5 sum of password, this is what is used as the encrypt key
-        m = md5checksum()
-        m.update(password)
-        md5key = m.digest()
-        cipher = TheBlowfishCipher(md5key)
+        key_state = None
+        magic_len = len(KEY_STATE_MAGIC)
+        if password[:magic_len] == KEY_STATE_MAGIC and len(password) in (magic_len + 16, magic_len + 16 + KEY_STATE_SIZE):
+            # result of export_key_state(); md5 of password and optionally the expanded key
+            md5key = password[magic_len:magic_len + 16]
+            key_state = password[magic_len + 16:]
+        else:
+            # Generate md5 sum of password, this is what is used as the encrypt key
+            m = md5checksum()
+            m.update(password)
+            md5key = m.digest()
+        # An imported expanded key can not be checked against md5key without
+        # running the (slow) key schedule, so it is only ever cached under the
+        # entire key state; a corrupt/crafted state can not affect ciphers
+        # for passwords (cached under md5key)
+        cache_key = password if key_state else md5key
+        cipher = key_cache.get(cache_key)
+        if cipher is None:
+            cipher = TheBlowfishCipher(md5key, key_state)
+            key_cache.put(cache_key, cipher)
     return cipher
 
+
+def export_key_state(password):
+    """Returns (bytes) key state for password, that can be passed to CHI_cipher() (or any
+    function taking a password) in place of the password. Can be stored or sent to other
+    processes, and when the backend allows it avoids the (slow) key schedule.
+    Ciphers returned by CHI_cipher() can also be pickled.
+    NOTE this is key material, treat it like a password
+    """
+    return CHI_cipher(password).export_key_state()
+
+def read_header(encrypted_bytes):
+    """Validates the header of Tombo file contents encrypted_bytes (bytes-like).
+    Returns tuple of (plaintext length, encrypted payload) where the
+    payload is a (zero-copy where supported) view of the bytes after the header.
+    Raises UnsupportedFile"""
+    # called version in CryptManager
+    header = encrypted_bytes[0:4]  # first 4 bytes
+    #print('DEBUG: header %r' % (header,))
+    if header != b'BF01' or len(encrypted_bytes) < 8:
+        raise UnsupportedFile('not a Tombo *.chi/*.chs file')
+
+    # read in 4 bytes and convert into an integer value
+    (enc_len,) = struct.unpack_from(FMT_STRUCT_4BYTE, encrypted_bytes, 4)
+    #print('DEBUG: enc_len %r' % (enc_len,))
+
+    enc_data = buffer_view(encrypted_bytes)[8:]  # rest of the bytes
+    encbuf_len = len(enc_data)
+    # print('read in %d bytes, of that only %d byte(s) are real data' % (encbuf_len , enc_len))
+    if encbuf_len % 8:
+        # there should be no bytes left over after the last (8 byte) block.
+        # This should not happen if it did this may be a corrupted file
+        release_view(enc_data)
+        raise UnsupportedFile('ExtraBytesFound during decryption')
+    return enc_len, enc_data
+
+
 MODE_ECB = 1  #  Electronic Code Book - https://peps.python.org/pep-0272/#introduction
 class PEP272LikeCipher():
     """PEP-272 Like... This is non-confirming:
@@ -284,80 +760,35 @@ class PEP272LikeCipher():
         # Assume key is a plain text string (i.e. a byte string, not Unicode type)
         self._key = CHI_cipher(key)  # _key is actually the underlying (Blowfish) Cipher with Tombo derived password/key
 
-    def decrypt(self, string):
+    def decrypt(self, string, jobs=None):
         """Decrypts 'string', using the key-dependent data in the object and with the appropriate feedback mode. The string's length must be an exact multiple of the algorithm's block size or, in CFB mode, of the segment size. Returns a string containing the plaintext.
         encrypt(string)
 
         NOTE string is BYTES!
         Returns bytes
-        NOTE does NOT require padding, padding logic is built in as this is ONLY for Tombo CHI/CHS so complete file contents should be pass in"""
+        NOTE does NOT require padding, padding logic is built in as this is ONLY for Tombo CHI/CHS so complete file contents should be pass in
+
+        jobs - number of processes to use, only used for data of at least
+            PARALLEL_DECRYPT_MIN_SIZE bytes and if multiprocessing.shared_memory
+            is available (Python 3.8+), see parallel_decrypt()"""
 
         # NOTE this code is almost identical to the code currently in read_encrypted_file(), difference is ChiIO exceptions are should catch all issues - RunTime exception is not raised unlike read_encrypted_file() for some bad inputs
 
         encrypted_bytes = string  # I hate the name in the pep, conflicts with stdlib :-(
+        # NOTE may also be bytearray, memoryview or mmap - processed without copying
 
-        # FIXME the slicing and new list creations!
-
-        # called version in CryptManager
-        header = encrypted_bytes[0:4]  # first 4 bytes
-        #print('DEBUG: header %r' % (header,))
-        if header != b'BF01':
-            raise UnsupportedFile('not a Tombo *.chi/*.chs file')
-
-        # read in 4 bytes and convert into an integer value
-        ## NOTE may need to worry about byte swap on big-endian hardware
-        # TODO do we need array lookup if we do not intend to byte swap???
-        tmpbuf = encrypted_bytes[4:8]  # next 4 bytes
-        #print('DEBUG: tmpbuf %r' % (header,))
-        # dump_bytes(tmpbuf)
-        xx = array.array(FMT_ARRAY_4BYTE, tmpbuf)
-        (enc_len,) = struct.unpack(FMT_STRUCT_4BYTE, xx)
-        # TODO consider replacing above with:
-        # (enc_len,) = struct.unpack(FMT_STRUCT_4BYTE, tmpbuf)
-        #print('DEBUG: enc_len %r' % (enc_len,))
-
-        enc_data = encrypted_bytes[8:]  # rest of the bytes
-        encbuf_len = len(enc_data)
-        # print('read in %d bytes, of that only %d byte(s) are real data' % (encbuf_len , enc_len))
-        #print('DEBUG: enc_data %r %r' % (len(enc_data), enc_data,))
-
-        cipher = self._key
+        enc_len, enc_data = read_header(encrypted_bytes)
+        try:
+            if can_parallel_decrypt(jobs, len(enc_data)):
+                return parallel_decrypt(self._key, enc_len, len(enc_data), jobs, enc_data=enc_data)
 
-        mycounter = encbuf_len
-        decrypted_data = []
-        second_pass = list(b"BLOWFISH")  # CBC IV/nonce
-        while mycounter >= 8:
-            data = enc_data[:8]
-            #print('')
-            #print('DEBUG: loop data %r %r' % (len(data), data,))
-            chipher = data
-            enc_data = enc_data[8:]
-            #print('DEBUG: loop enc_data %r %r' % (len(enc_data), enc_data,))
-            data = cipher.decrypt(data)
             ## based on debug code (and tombo specific additions to blowfish.c) in Tombo
             ## Tombo is using the base blowfish algorithm AND then applies more bit fiddling....
             ## performs bitwise exclusive-or on decrypted text from blowfish and "BLOWFISH" (note this static gets modified....)
-            for x in range(8):
-                tmp_byte_a = data[x]
-                tmp_byte_b = second_pass[x]
-                if not is_py3:  # py2
-                    tmp_byte_a = ord(tmp_byte_a)
-                    tmp_byte_b = ord(tmp_byte_b)
-
-                decrypted_data.append(tmp_byte_a ^ tmp_byte_b)
-                second_pass[x] = chipher[x]
-            mycounter = mycounter - 8
-        ## there should be no bytes left after this.
-        ## Ignore any remaining bytes (less than 8)?
-        if mycounter > 0:
-            # This should not happen if it did this may be a corrupted file
-            # at present not handled, pending on bugs found here
-            raise UnsupportedFile('ExtraBytesFound during decryption')
-        if is_py3:
-            decrypted_data = bytes(decrypted_data)
-        else:  # py2
-            decrypted_data = map(chr, decrypted_data)
-            decrypted_data = b''.join(decrypted_data)
+            ## i.e. CBC mode with a fixed IV
+            decrypted_data = cbc_decrypt(self._key, enc_data)
+        finally:
+            release_view(enc_data)
         """
         At this point decrypted_data contains:
             8 bytes of (unknown) random data
@@ -369,15 +800,13 @@ class PEP272LikeCipher():
         """
 
         # extract real text from supuriuos crap (24 bytes on from started of data)
-        # loose spurious end use real data length we read earlier?
-        unencrypted_str = decrypted_data[24:]
-        unencrypted_str = unencrypted_str[:enc_len]
+        # loose spurious end use real data length we read earlier
+        unencrypted_str = decrypted_data[24:24 + enc_len]
 
         m = md5checksum()
         m.update(unencrypted_str)
         decriptsum = m.digest()
-        chi_md5sum = decrypted_data[8:]
-        chi_md5sum = chi_md5sum[:16]
+        chi_md5sum = decrypted_data[8:24]
 
         if chi_md5sum == decriptsum:
             # passwords match, so data is valid
@@ -398,168 +827,1142 @@ class PEP272LikeCipher():
         i.e. '\x0D\x0A'. See dumb_unix2dos().
         """
 
-        # NOTE this code is almost identical to the code currently in write_encrypted_file()
         plain_text = string  # I hate the name in the pep, conflicts with stdlib :-(
 
         if not isinstance(plain_text, bytes):
             raise ChiIO('Only support 8-bit (binary/bytes) plaintext (got %r). Encode first, see help(codecs).' % type(plain_text))
 
-        plain_text_len = len(plain_text)
-        # print 'read in %d bytes' % plain_text_len
+        out = bytearray(encrypted_size(len(plain_text)))
+        encrypt_into_buffer(self._key, plain_text, out)
+        return bytes(out)
 
-        m = md5checksum()
-        m.update(plain_text)
-        plain_text_md5sum = m.digest()
+    def decrypt_into(self, string, out):
+        """Like decrypt() but writes the plaintext into the start of
+        writable buffer out (e.g. bytearray or memoryview), which must be at
+        least the plaintext length (bytes 4-7 of the header) long.
+        Returns the plaintext length.
 
-        # print "plain_text_md5sum"
-        # dump_bytes(plain_text_md5sum)
+        Where the backend supports output buffers (PyCryptodome) the
+        plaintext is decrypted directly into out, so reusing the same
+        buffer avoids any allocations proportional to the note size.
+        NOTE on BadPassword out contains garbage
+        """
+        enc_len, enc_data = read_header(string)
+        out_view = memoryview(out)
+        try:
+            tail_len = enc_len % 8
+            full_len = enc_len - tail_len
+            if len(enc_data) < 24 + full_len + (tail_len and 8):
+                raise UnsupportedFile('truncated Tombo *.chi/*.chs file')
+            if len(out_view) < enc_len:
+                raise ChiIO('out buffer too small, need %d bytes got %d' % (enc_len, len(out_view)))
+
+            # 8 bytes of salt and 16 byte md5 are the first 3 blocks, the plaintext is block aligned after that
+            decrypted_data = cbc_decrypt(self._key, enc_data[:24])
+            self._key.decrypt_cbc_into(enc_data[24:24 + full_len], enc_data[16:24], out_view[:full_len])
+            if tail_len:
+                decrypted_tail = cbc_decrypt(self._key, enc_data[24 + full_len:32 + full_len], enc_data[16 + full_len:24 + full_len])
+                out_view[full_len:enc_len] = decrypted_tail[:tail_len]
+
+            m = md5checksum()
+            m.update(out_view[:enc_len])
+        finally:
+            release_view(enc_data)
+            release_view(out_view)
+        if m.digest() != decrypted_data[8:24]:
+            raise BadPassword('for %r' % ('in-memory-buffer'))
+        return enc_len
+
+    def encrypt_into(self, string, out):
+        """Like encrypt() but writes the ciphertext into writable buffer out
+        (e.g. bytearray or memoryview), which must be at least
+        encrypted_size(len(string)) bytes long. Returns the number of bytes written.
+        Where the backend supports output buffers (PyCryptodome) the
+        ciphertext is encrypted directly into out.
+        """
+        plain_text = string
 
+        if not isinstance(plain_text, bytes):
+            raise ChiIO('Only support 8-bit (binary/bytes) plaintext (got %r). Encode first, see help(codecs).' % type(plain_text))
+        out_len = encrypted_size(len(plain_text))
+        if len(out) < out_len:
+            raise ChiIO('out buffer too small, need %d bytes got %d' % (out_len, len(out)))
+
+        return encrypt_into_buffer(self._key, plain_text, out)
+
+    def encrypt_many(self, plaintexts):
+        """Encrypts many plaintexts (each bytes), returns a list of ciphertexts in the same order.
+        Each result is identical in format to encrypt().
+
+        CBC encryption is serial within a note but independent across notes,
+        so the CBC chains of all notes are run in lockstep; block N of every
+        note (still with data left) is encrypted with a single (ECB) call into
+        the backend. This removes the per-call overhead that dominates when
+        encrypting many small notes. Notes of differing lengths are handled by
+        ordering the notes longest first, and Tombo's partial last blocks are
+        encrypted together at the end.
+
+        Measured with 20,000 notes of 100-500 bytes, compared with calling
+        encrypt() per note; PyCryptodome ~2.5x faster, NumPy ~17x faster,
+        pure Python backends no difference (the Blowfish rounds dominate).
+        """
         cipher = self._key
+        lanes = []
+        headers = []
+        for plain_text in plaintexts:
+            if not isinstance(plain_text, bytes):
+                raise ChiIO('Only support 8-bit (binary/bytes) plaintext (got %r). Encode first, see help(codecs).' % type(plain_text))
+            m = md5checksum()
+            m.update(plain_text)
+            lanes.append(os.urandom(8) + m.digest() + plain_text)
+            headers.append(b'BF01' + struct.pack(FMT_STRUCT_4BYTE, len(plain_text)))
+        lane_count = len(lanes)
+        if not lane_count:
+            return []
+
+        full_blocks = [len(data) // 8 for data in lanes]
+        order = sorted(range(lane_count), key=full_blocks.__getitem__, reverse=True)  # longest first
+        ordered_lanes = [lanes[i] for i in order]
+
+        # columns[N] is ciphertext block N of every note with (at least) N+1 full blocks, in `order`
+        columns = []
+        rests = {}  # position in `order` -> remaining full ciphertext blocks, encrypted one note at a time
+        chain = bytearray(CBC_IV * lane_count)  # previous ciphertext block of every note, in `order`, updated in place
+        active = lane_count
+        for block_number in range(full_blocks[order[0]]):
+            while full_blocks[order[active - 1]] <= block_number:
+                active -= 1  # shortest remaining note has no more full blocks, its chain is left as-is
+            if active <= full_blocks[order[active - 1]] - block_number:
+                # fewer notes left than blocks in the shortest of them (e.g. one long note),
+                # one backend CBC call per note is now fewer calls than continuing in lockstep
+                offset = block_number * 8
+                for position in range(active):
+                    data = ordered_lanes[position]
+                    full_len = len(data) - len(data) % 8
+                    rest = cipher.encrypt_cbc(data[offset:full_len], bytes(chain[position * 8:position * 8 + 8]))
+                    rests[position] = rest
+                    chain[position * 8:position * 8 + 8] = rest[-8:]
+                break
+            offset = block_number * 8
+            plain_column = b''.join([data[offset:offset + 8] for data in ordered_lanes[:active]])
+            column = cipher.encrypt(xor_bytes(plain_column, chain[:active * 8]))
+            columns.append(column)
+            chain[:active * 8] = column
+
+        # Tombo partial last blocks, see encrypt_into_buffer()
+        tails = []
+        for position, data in enumerate(ordered_lanes):
+            full_len = len(data) - len(data) % 8
+            if full_len != len(data):
+                previous_block = chain[position * 8:position * 8 + 8]
+                tail = xor_bytes(data[full_len:], previous_block[:len(data) - full_len])
+                tails.append((tail * 8)[:8])
+        tail_blocks = cipher.encrypt(b''.join(tails))
+
+        result = [None] * lane_count
+        tail_offset = 0
+        for position, lane_number in enumerate(order):
+            data = ordered_lanes[position]
+            offset = position * 8
+            encrypted_data = [headers[lane_number]]
+            encrypted_data.extend([column[offset:offset + 8] for column in columns[:full_blocks[lane_number]]])
+            if position in rests:
+                encrypted_data.append(rests[position])
+            if len(data) % 8:
+                encrypted_data.append(tail_blocks[tail_offset:tail_offset + 8])
+                tail_offset += 8
+            result[lane_number] = b''.join(encrypted_data)
+        return result
+
+
+def encrypt_many(plaintexts, password):
+    """Encrypts many plaintexts (each bytes) with the same password, returns a list
+    of ciphertexts (bytes) in the same order, each suitable for writing out as a *.chi / *.chs file.
+    See PEP272LikeCipher.encrypt_many().
+
+    password is a (byte) string, i.e. not Unicode type, or a cipher from CHI_cipher()
+    """
+    cipher = PEP272LikeCipher(password)
+    return cipher.encrypt_many(plaintexts)
 
-        ## create new buffer that will be encrypted, contains:
-        ##  8 bytes of random (if this is NOT random, then a plaintext+password will always create the SAME encrypted text)
-        ##  16 bytes of md5 of plaintext
-        ##  plain_text_len bytes of plaintext
-        # str_to_encrypt = '12345678' + plain_text_md5sum + plain_text
-        # enc_data = '12345678' + plain_text_md5sum + plain_text
-        enc_data = gen_random_string(8) + plain_text_md5sum + plain_text
 
-        mycounter = len(enc_data)
-        encrypted_data = b''
-        second_pass = b"BLOWFISH"  # CBC IV/nonce
-        while mycounter >= 8:
-            data = enc_data[:8]
+class ChiStat(namedtuple('ChiStat', 'filename is_chi plain_text_len expected_size file_size status error')):
+    """Result of chi_stat(), status is one of
+        STAT_OK, STAT_TRUNCATED, STAT_EXTRA_BYTES, STAT_NOT_CHI, STAT_ERROR
+    plain_text_len and expected_size are None if not is_chi.
+    error is the exception (e.g. IOError/OSError) if status is STAT_ERROR, otherwise None"""
+    __slots__ = ()
 
-            ## based on debug code (and tombo specific additions to blowfish.c) in Tombo
-            ## tombo is using the base blowfish alogrithm AND then applies more bit fiddling....
-            ## performs bitwise exclusive or on decrypted text from blowfish and "BLOWFISH" (note this static gets modified....)
-            plain = []
-            for x in range(8):
-                tmp_byte_a = data[x]
-                tmp_byte_b = second_pass[x]
-                if not is_py3:
-                    # py2
-                    tmp_byte_a = ord(tmp_byte_a)
-                    tmp_byte_b = ord(tmp_byte_b)
-                plain.append(tmp_byte_a ^ tmp_byte_b)
-            # print 'dec pass2 ', plain
-            if is_py3:
-                data = bytes(plain)
-            else:  # py2
-                data = map(chr, plain)
-                data = b''.join(data)
-            # print data
-            # dump_bytes(data)
-
-            enc_data = enc_data[8:]
-            ##debug
-            # first_byte = ord(data[0])
-            # print 'raw : %x, %d' %(first_byte , first_byte )
-            # dump_bytes(data)
-            data = cipher.encrypt(data)
-
-            # take encrypted block and shove into second pass bit fiddler (really first pass when encrypting
-            second_pass = []
-            for x in range(8):
-                second_pass.append(data[x])
-            if is_py3:
-                second_pass = bytes(second_pass)
-            else:
-                second_pass = ''.join(second_pass)
-
-            ##debug
-            # first_byte = ord(data[0])
-            # print 'encrypted : %x, %d' %(first_byte , first_byte )
-            # print ""
-            encrypted_data = encrypted_data + data
-            mycounter = mycounter - 8
-        ## there maybe a few odd bytes left after this (less than 8). Take then and put with random bytes into an 8 byte block and encrypt that
-        if mycounter > 0:
-            # take  last few bytes "data"
-            tmp_buf = []
-            for x in range(mycounter):
-                tmp_buf.append(enc_data[x])
-            if is_py3:
-                data = bytes(tmp_buf)
-            else:
-                data = ''.join(tmp_buf)
-
-            # Tombo bit fiddling
-            # NOTE in Tombo the "fake" padding bytes at the end are not bit fiddled with
-            plain = []
-            for x in range(mycounter):
-                tmp_byte_a = data[x]
-                tmp_byte_b = second_pass[x]
-                if not is_py3:  # is py2
-                    tmp_byte_a = ord(tmp_byte_a)
-                    tmp_byte_b = ord(tmp_byte_b)
-                plain.append(tmp_byte_a ^ tmp_byte_b)
-            if is_py3:
-                data = plain
-            else:
-                data = map(chr, plain)
+ChiStat.__new__.__defaults__ = (None,)  # error
+
+STAT_OK = 'ok'
+STAT_TRUNCATED = 'truncated'  # file is shorter than the header claims, note is corrupt
+STAT_EXTRA_BYTES = 'extra_bytes'  # file is longer than the header claims
+STAT_NOT_CHI = 'not_chi'  # no BF01 header
+STAT_ERROR = 'error'  # file could not be read (scan_tree() only, chi_stat() raises)
+
+
+def _chi_stat(filename, file_size=None):
+    in_file = open(filename, 'rb')
+    try:
+        header = in_file.read(8)
+        if file_size is None:
+            file_size = os.fstat(in_file.fileno()).st_size
+    finally:
+        in_file.close()
+    if len(header) < 8 or header[:4] != b'BF01':
+        return ChiStat(filename, False, None, None, file_size, STAT_NOT_CHI)
+    (plain_text_len,) = struct.unpack(FMT_STRUCT_4BYTE, header[4:])
+    expected_size = encrypted_size(plain_text_len)
+    if file_size < expected_size:
+        status = STAT_TRUNCATED
+    elif file_size > expected_size:
+        status = STAT_EXTRA_BYTES
+    else:
+        status = STAT_OK
+    return ChiStat(filename, True, plain_text_len, expected_size, file_size, status)
 
-            # pad the end few bytes so that blowfish can be applied
-            # just take "garbage" from begnning of (last/previously) encrypted block
-            # NOTE this differs from Tombo which takes the garbage from the end of the previously encrypted block
-            for x in range(8 - mycounter):
-                data.append(data[x])
 
-            if is_py3:
-                data = bytes(plain)
-            else:  # is py2
-                data = b''.join(data)
+def chi_stat(filename):
+    """Checks a *.chi / *.chs file without a password, only the 8 byte header is read.
+    Returns ChiStat namedtuple (filename, is_chi, plain_text_len, expected_size, file_size, status).
+    No decryption is performed, so a valid status does not mean the md5/password are correct.
+    """
+    return _chi_stat(filename)
 
-            # Now encrypt
-            data = cipher.encrypt(data)
-            encrypted_data = encrypted_data + data
 
-        # FIXME avoid concatenation
-        """
-        return b'BF01' +  # header, called version in tombo's CryptManager
-            struct.pack(FMT_STRUCT_4BYTE, plain_text_len) +  # 4 bytes - integer value containing unencrypted length of data
-            encrypted_data
-        """
-        return b'BF01' + struct.pack(FMT_STRUCT_4BYTE, plain_text_len) + encrypted_data
+def iter_tree_files(root, extensions=CHI_EXTENSIONS):
+    """Generator, walks directory root (recursively) yielding tuples of
+    (filename, file size) for each file that ends in one of extensions
+    (case insensitive), in sorted order.
+    Uses os.scandir() when available, which avoids extra stat calls on some platforms.
+    Like os.walk(), directories that can not be listed are skipped, as are
+    files removed while listing.
+    """
+    extensions = tuple(x.lower() for x in extensions)
+    if scandir is None:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith(extensions):
+                    filename = os.path.join(dirpath, filename)
+                    try:
+                        file_size = os.path.getsize(filename)
+                    except OSError:
+                        continue  # removed
+                    yield filename, file_size
+        return
+
+    dirs = [root]
+    while dirs:
+        dirpath = dirs.pop()
+        subdirs = []
+        try:
+            entries = sorted(scandir(dirpath), key=lambda x: x.name)
+        except OSError:
+            continue  # e.g. permission denied, as os.walk()
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if not (entry.name.lower().endswith(extensions) and entry.is_file()):
+                    continue
+                file_size = entry.stat().st_size
+            except OSError:
+                continue  # removed
+            yield entry.path, file_size
+        dirs.extend(reversed(subdirs))
+
+
+def scan_tree(root, extensions=CHI_EXTENSIONS):
+    """Generator, walks directory root (recursively) calling chi_stat() for
+    each file that ends in one of extensions (case insensitive). Yields ChiStat.
+    No password is needed, no decryption is performed.
+    Files that can not be read (e.g. permission denied, removed during the
+    scan) do not stop the scan, they are yielded with status STAT_ERROR and
+    the exception in error.
+    """
+    for filename, file_size in iter_tree_files(root, extensions):
+        try:
+            result = _chi_stat(filename, file_size)
+        except (IOError, OSError) as info:
+            result = ChiStat(filename, False, None, None, file_size, STAT_ERROR, info)
+        yield result
 
 
-def read_encrypted_file(fileinfo, password):
+def read_encrypted_file(fileinfo, password, use_mmap=False, jobs=None, cache=None):
     """Reads a *.chi / *.chs file encrypted by Tombo. Returns (8 bit) string containing plaintext.
     Raises exceptions on failure.
 
-    fileinfo is either a filename (string) or a file-like object that reads binary bytes that be can read (caller is responsible for closing)
+    fileinfo is either a filename (string), a file-like object that reads binary bytes that be can read (caller is responsible for closing),
+        or the encrypted bytes already in memory as a bytearray, memoryview or mmap (processed without copying)
     password is a (byte) string, i.e. not Unicode type
+    use_mmap - if fileinfo is a filename, memory map the file rather than reading it into memory
+    jobs - number of processes to use to decrypt (large) files, see PEP272LikeCipher.decrypt().
+        If fileinfo is a filename the worker processes memory map (their part of) the file
+    cache - optional PlainTextCache, repeat reads of unchanged files skip decryption
+        (not used if password is a Keyring)
     """
     if password is None:
         raise BadPassword('None passed in for password for file %r' % (fileinfo or 'file-like-object'))
-
-    if isinstance(fileinfo, basestring):
-        enc_filename = fileinfo
-        in_file = open(enc_filename, 'rb')
-    else:
-        # assume it is a file-like object
-        in_file = fileinfo
-        ## TODO look up filename from object, file-likes usually have an attribute
-        # enc_filename = in_file.name
+    if isinstance(password, Keyring):
+        return password.read(fileinfo, use_mmap=use_mmap, jobs=jobs)
+    if cache is not None:
+        return cache.read(fileinfo, password, use_mmap=use_mmap, jobs=jobs)
+
+    in_file = None
+    mapped_file = None
+    if isinstance(fileinfo, (bytearray, memoryview, mmap.mmap)):
+        crypted_data = fileinfo
         enc_filename = None
-
-    crypted_data = in_file.read()  # need to read entire file
-    if enc_filename:
-        in_file.close()
+    else:
+        if isinstance(fileinfo, basestring):
+            enc_filename = fileinfo
+            in_file = open(enc_filename, 'rb')
+        else:
+            # assume it is a file-like object
+            in_file = fileinfo
+            ## TODO look up filename from object, file-likes usually have an attribute
+            # enc_filename = in_file.name
+            enc_filename = None
+
+        if enc_filename:
+            # check the header before reading (or mapping) a potentially large non-Tombo file
+            header = in_file.read(8)
+            if header[:4] != b'BF01':
+                in_file.close()
+                raise UnsupportedFile('not a Tombo *.chi/*.chs file %r' % enc_filename)
+            in_file.seek(0)
+            payload_len = os.fstat(in_file.fileno()).st_size - 8
+            if can_parallel_decrypt(jobs, payload_len):
+                in_file.close()
+                if payload_len % 8:
+                    raise UnsupportedFile('ExtraBytesFound during decryption')
+                (enc_len,) = struct.unpack(FMT_STRUCT_4BYTE, header[4:8])
+                try:
+                    return parallel_decrypt(CHI_cipher(password), enc_len, payload_len, jobs, filename=enc_filename)
+                except BadPassword:
+                    raise BadPassword('Incorrect password for %r' % enc_filename)
+        if enc_filename and use_mmap and os.fstat(in_file.fileno()).st_size:
+            crypted_data = mapped_file = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            crypted_data = in_file.read()  # need to read entire file
 
     cipher = PEP272LikeCipher(password)
     try:
-        unencrypted_str = cipher.decrypt(crypted_data)
+        unencrypted_str = cipher.decrypt(crypted_data, jobs=jobs)
     except BadPassword:
         # password did not match, data is bogus
         # raise exception WITH information such as filename, do not dump out password as that could be a security hole
         # FIXME tests do not detect if this extra information is missing
         raise BadPassword('Incorrect password for %r' % (enc_filename or 'file-like-object'))
+    finally:
+        try:
+            if mapped_file is not None:
+                crypted_data = None
+                mapped_file.close()
+        finally:
+            if enc_filename:
+                in_file.close()
 
     return unencrypted_str
 
 
-def write_encrypted_file(fileinfo, password, plaintext):
+def _stat_identity(st):
+    # py2 has no st_mtime_ns
+    return st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino, st.st_dev
+
+
+class PlainTextCache(object):
+    """Thread safe cache of decrypted plaintext, see read_encrypted_file(..., cache=...)
+    Bounded by max_bytes (total plaintext held), least recently used are evicted first.
+
+    Filenames are keyed on the (absolute) path and validated against
+    (size, mtime, inode, device) from os.stat(), so a hit costs a stat()
+    and a dict lookup, and entries for changed files are discarded.
+    File-like objects and in memory bytes are keyed on a (sha256) hash of the
+    entire ciphertext, so a hit costs reading and hashing it (a fraction of
+    the cost of decrypting) and a dict lookup; without hashlib (sha256) they
+    are not cached.
+    Entries are also keyed on the (md5 of the) password, a different
+    password never gets a hit.
+
+    max_bytes - plaintext larger than this is never cached, 0 disables the cache
+
+    NOTE plaintext is held in memory until evicted, invalidated or clear() is called.
+    A file rewritten in place with the same size within the filesystem's mtime
+    resolution is not detected, writers should call invalidate().
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (identity, plaintext)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, identity=None):
+        """Returns plaintext for key, or None if not present (or cached for a different identity)"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] == identity:
+                    self._entries[key] = entry  # now most recently used
+                    self.hits += 1
+                    return entry[1]
+                self._bytes -= len(entry[1])
+                self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, plain_text, identity=None):
+        with self._lock:
+            if self.max_bytes <= 0 or len(plain_text) > self.max_bytes:
+                return
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry[1])
+            self._entries[key] = (identity, plain_text)
+            self._bytes += len(plain_text)
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)  # least recently used
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, filename):
+        """Discard any entry for filename, e.g. after writing it"""
+        with self._lock:
+            entry = self._entries.pop(os.path.abspath(filename), None)
+            if entry is not None:
+                self._bytes -= len(entry[1])
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Returns dict of hits, misses, evictions, invalidations, (current) entries and bytes"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'entries': len(self._entries), 'bytes': self._bytes}
+
+    def read(self, fileinfo, password, use_mmap=False, jobs=None):
+        """Cached read_encrypted_file()"""
+        cipher = CHI_cipher(password)
+        if isinstance(fileinfo, basestring):
+            key = os.path.abspath(fileinfo)
+            identity = cipher._password_key, _stat_identity(os.stat(fileinfo))
+            plain_text = self.get(key, identity)
+            if plain_text is None:
+                plain_text = read_encrypted_file(fileinfo, cipher, use_mmap=use_mmap, jobs=jobs)
+                if identity[1] == _stat_identity(os.stat(fileinfo)):  # not changed while reading
+                    self.put(key, plain_text, identity)
+            return plain_text
+
+        if isinstance(fileinfo, (bytearray, memoryview, mmap.mmap)):
+            crypted_data = fileinfo
+        else:
+            # assume it is a file-like object
+            crypted_data = fileinfo.read()
+        key = plain_text = None
+        if sha256checksum is not None:
+            key = cipher._password_key, sha256checksum(crypted_data).digest()
+            plain_text = self.get(key)
+        if plain_text is None:
+            try:
+                plain_text = PEP272LikeCipher(cipher).decrypt(crypted_data, jobs=jobs)
+            except BadPassword:
+                raise BadPassword('Incorrect password for %r' % 'file-like-object')  # as read_encrypted_file()
+            if key is not None:
+                self.put(key, plain_text)
+        return plain_text
+
+
+def _tail_padding_ok(cipher, enc_data, enc_len):
+    """Cheap (one block) check that cipher could be the key for enc_data.
+    The partial last block is padded before encryption, Tombo pads with the
+    end of the previous ciphertext block, chi_io by repeating the real bytes.
+    Returns False if neither padding is found (almost certainly the wrong key),
+    True otherwise (including when there is no partial block to check).
+    NOTE other writers may pad differently, so only use this to order attempts
+    """
+    tail_len = enc_len % 8
+    if not tail_len or len(enc_data) < 16:
+        return True
+    previous_block = bytes(enc_data[-16:-8])
+    last_block = cipher.decrypt(bytes(enc_data[-8:]))
+    padding = last_block[tail_len:]
+    return padding == previous_block[tail_len:] or padding == (last_block[:tail_len] * 8)[tail_len:8]
+
+
+class Keyring(object):
+    """Several passwords, for vaults with notes encrypted under different passwords.
+    Pass in place of a password to read_encrypted_file(), or call read().
+
+    Ciphers are expanded once (see CHI_cipher()). The key that last opened
+    a file in each directory is remembered and tried first, then the
+    rest in most recently successful order. Before any full decrypt the
+    last block of the file is decrypted with each key to check its padding
+    (see _tail_padding_ok()), keys that fail are only tried after the rest,
+    so opening a file usually costs one full decrypt rather than one per key.
+    Thread safe.
+    """
+
+    def __init__(self, passwords=()):
+        self._lock = threading.Lock()
+        self._ciphers = OrderedDict()  # md5key -> cipher, most recently successful first
+        self._last_used = {}  # absolute directory name -> md5key, one entry per directory (not per file) so it stays small
+        for password in passwords:
+            self.add(password)
+
+    def add(self, password):
+        """Add password (or cipher from CHI_cipher()), tried after existing keys. Returns the cipher"""
+        cipher = CHI_cipher(password)
+        with self._lock:
+            self._ciphers.setdefault(cipher._password_key, cipher)
+        return cipher
+
+    def __len__(self):
+        return len(self._ciphers)
+
+    def ciphers(self, filename=None):
+        """Returns list of ciphers in the order they will be tried for filename"""
+        with self._lock:
+            ciphers = list(self._ciphers.values())
+            if filename is not None:
+                cipher = self._ciphers.get(self._last_used.get(os.path.dirname(os.path.abspath(filename))))
+                if cipher is not None:
+                    ciphers.remove(cipher)
+                    ciphers.insert(0, cipher)
+        return ciphers
+
+    def _opened(self, cipher, filename=None):
+        with self._lock:
+            md5key = cipher._password_key
+            others = [item for item in self._ciphers.items() if item[0] != md5key]
+            self._ciphers.clear()
+            self._ciphers[md5key] = cipher  # now most recently successful
+            self._ciphers.update(others)
+            if filename is not None:
+                self._last_used[os.path.dirname(os.path.abspath(filename))] = md5key
+
+    def find_cipher(self, crypted_data, filename=None, jobs=None):
+        """Returns tuple (cipher, plaintext) for the first key that decrypts
+        crypted_data (bytes, bytearray, memoryview or mmap), raises BadPassword if none do.
+        filename is used to pick the order keys are tried in, and is remembered on success
+        """
+        enc_len, enc_data = read_header(crypted_data)  # raises UnsupportedFile regardless of key
+        likely, unlikely = [], []
+        try:
+            for cipher in self.ciphers(filename):
+                (likely if _tail_padding_ok(cipher, enc_data, enc_len) else unlikely).append(cipher)
+        finally:
+            release_view(enc_data)  # so an mmap'd crypted_data can be closed, even if BadPassword is raised
+        for cipher in likely + unlikely:
+            try:
+                plain_text = PEP272LikeCipher(cipher).decrypt(crypted_data, jobs=jobs)
+            except BadPassword:
+                continue
+            self._opened(cipher, filename)
+            return cipher, plain_text
+        raise BadPassword('No password in keyring for %r' % (filename or 'file-like-object'))
+
+    def read(self, fileinfo, use_mmap=False, jobs=None):
+        """Keyring version of read_encrypted_file(), returns plaintext bytes.
+        Raises BadPassword if no key decrypts fileinfo"""
+        if isinstance(fileinfo, (bytearray, memoryview, mmap.mmap)):
+            return self.find_cipher(fileinfo, jobs=jobs)[1]
+        if not isinstance(fileinfo, basestring):
+            # assume it is a file-like object
+            return self.find_cipher(fileinfo.read(), jobs=jobs)[1]
+        in_file = open(fileinfo, 'rb')
+        try:
+            if use_mmap and os.fstat(in_file.fileno()).st_size:
+                mapped_file = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return self.find_cipher(mapped_file, fileinfo, jobs=jobs)[1]
+                finally:
+                    mapped_file.close()
+            return self.find_cipher(in_file.read(), fileinfo, jobs=jobs)[1]
+        finally:
+            in_file.close()
+
+
+_tree_cipher = None  # process pool worker cipher, see _tree_worker_init()
+
+
+def _tree_worker_init(key_state):
+    """Process pool worker initializer, key_state is from export_key_state()"""
+    global _tree_cipher
+    _tree_cipher = CHI_cipher(key_state)
+
+
+def _new_process_pool(jobs, key_state):
+    """Returns tuple of (ProcessPoolExecutor, key_state to pass to each work item).
+    Workers are initialized with key_state (from export_key_state()), if the
+    pool does not support initializers (Python < 3.7) key_state must be passed
+    in with each work item, otherwise it is None"""
+    try:
+        return ProcessPoolExecutor(jobs, initializer=_tree_worker_init, initargs=(key_state,)), None
+    except TypeError:
+        # Python < 3.7, no initializer
+        return ProcessPoolExecutor(jobs), key_state
+
+
+def _decrypt_tree_file(cipher, filename):
+    try:
+        return filename, read_encrypted_file(filename, cipher), None
+    except Exception as info:
+        return filename, None, info
+
+
+def _decrypt_tree_batch(filenames, key_state=None):
+    """Process pool worker, decrypts a list of filenames.
+    key_state is only passed in if the pool does not support initializers (Python < 3.7)"""
+    if key_state is not None:
+        _tree_worker_init(key_state)
+    return [_decrypt_tree_file(_tree_cipher, filename) for filename in filenames]
+
+
+def _batch_by_size(files, jobs):
+    """Split list of (filename, size) into lists of filenames, largest files first.
+    Batches are roughly total_size / (jobs * 4) bytes, so large files are on
+    their own, small files are grouped (reducing inter-process overhead)
+    and workers that finish early pick up more batches"""
+    files = sorted(files, key=lambda x: x[1], reverse=True)
+    target_size = max(sum(size for filename, size in files) // (jobs * 4), 64 * 1024)
+    batches = []
+    batch, batch_size = [], 0
+    for filename, size in files:
+        batch.append(filename)
+        batch_size += size
+        if batch_size >= target_size:
+            batches.append(batch)
+            batch, batch_size = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def imap_decrypt_tree(root, password, jobs=None, extensions=CHI_EXTENSIONS):
+    """Generator, decrypts every *.chi / *.chs file under directory root using
+    a pool of jobs processes (default is the number of CPUs).
+    Yields (filename, plain_text, exception) tuples as files complete (NOT in order),
+    plain_text is None and exception is set (e.g. BadPassword, UnsupportedFile) for
+    files that failed.
+
+    Workers receive the key once (see export_key_state()), files are batched
+    by size (largest first) to balance load across workers.
+    If concurrent.futures is not available (py2 without the futures backport)
+    or jobs is 1, files are decrypted in this process.
+    NOTE on Windows (and other spawn platforms) callers need the usual
+    `if __name__ == '__main__':` guard.
+    """
+    cipher = CHI_cipher(password)
+    files = list(iter_tree_files(root, extensions))
+    if jobs is None:
+        jobs = cpu_count() or 1
+    if ProcessPoolExecutor is None or jobs <= 1 or len(files) <= 1:
+        for filename, size in files:
+            yield _decrypt_tree_file(cipher, filename)
+        return
+
+    executor, batch_key_state = _new_process_pool(jobs, cipher.export_key_state())
+    futures = []
+    try:
+        for batch in _batch_by_size(files, jobs):
+            futures.append(executor.submit(_decrypt_tree_batch, batch, batch_key_state))
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
+    finally:
+        for future in futures:
+            future.cancel()  # generator closed early
+        executor.shutdown(wait=True)
+
+
+def decrypt_tree(root, password, jobs=None, extensions=CHI_EXTENSIONS):
+    """Decrypts every *.chi / *.chs file under directory root in parallel, see imap_decrypt_tree().
+    Returns dictionary of filename to plaintext bytes, or to the exception
+    (e.g. BadPassword, UnsupportedFile) for files that could not be decrypted.
+    """
+    result = {}
+    for filename, plain_text, exception in imap_decrypt_tree(root, password, jobs=jobs, extensions=extensions):
+        result[filename] = plain_text if exception is None else exception
+    return result
+
+
+PARALLEL_DECRYPT_MIN_SIZE = 8 * 1024 * 1024  # bytes, smaller files are not worth the process startup
+PARALLEL_DECRYPT_MIN_CHUNK = 1024 * 1024  # bytes decrypted by each work item, multiple of 8 (block size)
+
+
+def can_parallel_decrypt(jobs, payload_len):
+    """Returns True if parallel_decrypt() can and should be used"""
+    return bool(jobs and jobs > 1 and payload_len >= PARALLEL_DECRYPT_MIN_SIZE and ProcessPoolExecutor is not None and shared_memory is not None)
+
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        # NOTE older versions register with the resource tracker again, pool workers share the creators tracker so this is harmless
+        return shared_memory.SharedMemory(name=name)
+
+
+def _parallel_decrypt_worker(filename, in_name, in_offset, out_name, start, end, key_state=None):
+    """Process pool worker, CBC decrypts payload bytes [start, end) into shared memory out_name.
+    Ciphertext is read from (memory mapped) filename or shared memory in_name, starting at in_offset.
+    key_state is only passed in if the pool does not support initializers (Python < 3.7)"""
+    if key_state is not None:
+        _tree_worker_init(key_state)
+    out_shm = _attach_shared_memory(out_name)
+    if filename:
+        in_file = open(filename, 'rb')
+        mapped_file = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        src = memoryview(mapped_file)
+    else:
+        in_shm = _attach_shared_memory(in_name)
+        src = in_shm.buf
+    enc_data = src[in_offset + start:in_offset + end]
+    iv = src[in_offset + start - 8:in_offset + start] if start else CBC_IV
+    out = out_shm.buf[start:end]
+    try:
+        _tree_cipher.decrypt_cbc_into(enc_data, iv, out)
+    finally:
+        # views must be released before the memory can be closed
+        out.release()
+        enc_data.release()
+        if start:
+            iv.release()
+        out_shm.close()
+        if filename:
+            src.release()
+            mapped_file.close()
+            in_file.close()
+        else:
+            in_shm.close()
+
+
+def parallel_decrypt(cipher, enc_len, payload_len, jobs, enc_data=None, filename=None):
+    """Decrypts a Tombo payload (everything after the 8 byte header) using a pool of jobs processes.
+    Returns the plaintext (bytes), raises BadPassword.
+
+    CBC decryption of a block only needs the previous ciphertext block, so
+    the payload is split into (block aligned) chunks that workers decrypt
+    independently, writing directly into shared memory (rather than
+    pickling the plaintext back). The md5 is sequential, so it is streamed;
+    each chunk is hashed (in order) as it completes, overlapping with workers
+    still decrypting later chunks.
+
+    cipher is from CHI_cipher(), enc_len is the plaintext length from the header.
+    Ciphertext is either enc_data (bytes-like, copied into shared memory)
+    or filename (workers memory map the file).
+    """
+    chunk_size = max(PARALLEL_DECRYPT_MIN_CHUNK, payload_len // (jobs * 4) // 8 * 8)
+    out_shm = shared_memory.SharedMemory(create=True, size=payload_len)
+    in_shm = None
+    try:
+        if filename:
+            in_name, in_offset = None, 8  # skip header
+        else:
+            in_shm = shared_memory.SharedMemory(create=True, size=payload_len)
+            in_shm.buf[:payload_len] = enc_data
+            in_name, in_offset = in_shm.name, 0
+        executor, batch_key_state = _new_process_pool(jobs, cipher.export_key_state())
+        futures = []
+        try:
+            starts = range(0, payload_len, chunk_size)
+            for start in starts:
+                futures.append(executor.submit(_parallel_decrypt_worker, filename, in_name, in_offset, out_shm.name, start, min(start + chunk_size, payload_len), batch_key_state))
+            ## plaintext is payload [24, 24 + enc_len), after 8 random bytes and 16 byte md5
+            m = md5checksum()
+            plain_text_end = min(24 + enc_len, payload_len)
+            for start, future in zip(starts, futures):
+                future.result()
+                lo, hi = max(start, 24), min(start + chunk_size, plain_text_end)
+                if lo < hi:
+                    m.update(out_shm.buf[lo:hi])
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        if m.digest() != bytes(out_shm.buf[8:24]):
+            # password did not match, data is bogus
+            raise BadPassword('for %r' % ('in-memory-buffer'))
+        return bytes(out_shm.buf[24:plain_text_end])
+    finally:
+        out_shm.close()
+        out_shm.unlink()
+        if in_shm is not None:
+            in_shm.close()
+            in_shm.unlink()
+
+
+DEFAULT_HEAD_SIZE = 256  # bytes of plaintext decrypted by read_head() / read_title()
+
+
+def _read_start(fileinfo, read_len):
+    """Returns tuple (first read_len bytes of a *.chi / *.chs file, plaintext length from header).
+    fileinfo is a filename, file-like object or bytearray/memoryview/mmap.
+    Raises UnsupportedFile"""
+    if isinstance(fileinfo, (bytearray, memoryview, mmap.mmap)):
+        crypted_data = buffer_view(fileinfo)[:read_len]
+    elif isinstance(fileinfo, basestring):
+        in_file = open(fileinfo, 'rb')
+        try:
+            crypted_data = in_file.read(read_len)
+        finally:
+            in_file.close()
+    else:
+        crypted_data = fileinfo.read(read_len)
+
+    if len(crypted_data) < 8 or crypted_data[0:4] != b'BF01':
+        raise UnsupportedFile('not a Tombo *.chi/*.chs file')
+    (enc_len,) = struct.unpack_from(FMT_STRUCT_4BYTE, crypted_data, 4)
+    return crypted_data, enc_len
+
+
+def read_head(fileinfo, password, nbytes=DEFAULT_HEAD_SIZE):
+    """Decrypts only the start of a *.chi / *.chs file, e.g. for note titles and previews.
+    Returns tuple (plaintext, verified), plaintext is the first nbytes of the note
+    (or less if the note is shorter).
+
+    CBC allows decrypting any block given the previous ciphertext block,
+    so only the header and the ciphertext blocks covering the first nbytes
+    are read and decrypted, cost does not depend on note size.
+    NOTE the md5 covers the entire note so the plaintext can only be
+    verified if nbytes covers the whole note (verified is True and
+    BadPassword raised on mismatch). Otherwise verified is False and a
+    bad password results in garbage plaintext.
+
+    fileinfo is either a filename (string), a file-like object (read from the current position)
+        or the encrypted bytes already in memory as a bytearray, memoryview or mmap
+    password is a (byte) string, i.e. not Unicode type, or a cipher from CHI_cipher()
+    """
+    ## 8 byte header, then 3 blocks of 8 random bytes and 16 byte md5, then plaintext (block aligned)
+    crypted_data, enc_len = _read_start(fileinfo, 8 + 24 + ((nbytes + 7) // 8) * 8)
+    nbytes = min(nbytes, enc_len)
+    head_len = 24 + ((nbytes + 7) // 8) * 8
+    if len(crypted_data) < 8 + head_len:
+        raise UnsupportedFile('truncated Tombo *.chi/*.chs file')
+
+    cipher = CHI_cipher(password)
+    enc_data = crypted_data[8:8 + head_len]
+    if nbytes == enc_len:
+        # entire note, can check md5
+        decrypted_data = cbc_decrypt(cipher, enc_data)
+        plain_text = decrypted_data[24:24 + nbytes]
+        if md5checksum(plain_text).digest() != decrypted_data[8:24]:
+            raise BadPassword('for %r' % (fileinfo if isinstance(fileinfo, basestring) else 'file-like-object'))
+        return plain_text, True
+    # skip the random bytes and md5, previous ciphertext block is the IV
+    plain_text = cbc_decrypt(cipher, enc_data[24:], enc_data[16:24])
+    return plain_text[:nbytes], False
+
+
+def read_title(fileinfo, password, nbytes=DEFAULT_HEAD_SIZE):
+    """Returns the first line (bytes, without line ending) of a *.chi / *.chs file,
+    Tombo uses this as the note title. At most nbytes are decrypted, see read_head()
+    NOTE the title is not verified unless the note is no longer than nbytes
+    """
+    plain_text = read_head(fileinfo, password, nbytes)[0]
+    return plain_text.split(b'\n', 1)[0].rstrip(b'\r')
+
+
+def read_fingerprint(fileinfo, password):
+    """Returns tuple (plaintext length, 16 byte md5 digest of the plaintext)
+    identifying the content of a *.chi / *.chs file, e.g. for change/duplicate
+    detection or cache keys. Tombo stores the md5 of the plaintext in the
+    encrypted payload (after 8 random bytes), so only the 32 bytes of header
+    and first 3 blocks are read and decrypted.
+    NOTE nothing is verified, with the wrong password the md5 is garbage
+    (consistent garbage, the same password/file always returns the same value).
+
+    fileinfo is either a filename (string), a file-like object (read from the current position)
+        or the encrypted bytes already in memory as a bytearray, memoryview or mmap
+    password is a (byte) string, i.e. not Unicode type, or a cipher from CHI_cipher()
+    """
+    crypted_data, enc_len = _read_start(fileinfo, 8 + 24)
+    if len(crypted_data) < 8 + 24:
+        raise UnsupportedFile('truncated Tombo *.chi/*.chs file')
+    # previous ciphertext block (the first) is the IV for the md5 blocks
+    md5sum = cbc_decrypt(CHI_cipher(password), crypted_data[16:32], crypted_data[8:16])
+    return enc_len, md5sum
+
+
+def fingerprint_tree(root, password, extensions=CHI_EXTENSIONS):
+    """Generator, calls read_fingerprint() for each *.chi / *.chs file under directory root.
+    Yields (filename, fingerprint, exception) tuples, fingerprint is None
+    and exception is set (e.g. UnsupportedFile) for files that failed.
+    """
+    cipher = CHI_cipher(password)
+    for filename, file_size in iter_tree_files(root, extensions):
+        try:
+            result = filename, read_fingerprint(filename, cipher), None
+        except Exception as info:
+            result = filename, None, info
+        yield result
+
+
+def is_unchanged(fileinfo, password, plain_text_md5sum, plain_text_len):
+    """Returns True if existing *.chi / *.chs fileinfo already holds plaintext
+    with md5 digest plain_text_md5sum and length plain_text_len, i.e. rewriting
+    it would not change the content. Only the header blocks are decrypted, see read_fingerprint().
+    Missing or unreadable files (and files using a different password) return False.
+
+    fileinfo is either a filename (string) or a file-like object (read from the current position)
+    password is a (byte) string, i.e. not Unicode type, or a cipher from CHI_cipher()
+    """
+    try:
+        return read_fingerprint(fileinfo, password) == (plain_text_len, plain_text_md5sum)
+    except (IOError, OSError, UnsupportedFile):
+        return False
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024  # bytes read at a time by streaming functions
+DEFAULT_SPOOL_SIZE = 1024 * 1024  # ChiAsFile write buffer held in memory before spilling to a temporary file
+
+
+class ChiDecoder(object):
+    """Push style (sans-I/O) decryption of Tombo *.chi / *.chs data.
+    Feed in encrypted bytes, in chunks of any size, get back plaintext bytes
+    as soon as they can be decrypted. Uses constant memory.
+
+        decoder = ChiDecoder(password)
+        for chunk in chunks:
+            out_file.write(decoder.feed(chunk))
+        out_file.write(decoder.finish())  # raises BadPassword if md5 does not match
+
+    NOTE plaintext returned by feed() is NOT verified, the md5 covers the
+    entire plaintext and is only checked by finish(). Callers must discard
+    any output if finish() raises an exception.
+
+    password is a (byte) string, i.e. not Unicode type, or a cipher from CHI_cipher()
+    """
+
+    def __init__(self, password):
+        self._cipher = CHI_cipher(password)
+        self._pending = b''  # bytes not yet processed, header or partial block
+        self._chain = CBC_IV  # previous ciphertext block
+        self._prefix = b''  # first 24 decrypted bytes; 8 bytes random and 16 byte md5sum
+        self._md5 = md5checksum()
+        self.plain_text_len = None  # from header, None until header has been read
+        self._remaining = None  # plaintext bytes still expected
+        self.finished = False
+
+    def feed(self, data):
+        """Process (encrypted) bytes data, returns (unverified) plaintext bytes, may be empty"""
+        if self.finished:
+            raise ValueError('feed() called after finish()')
+        if self._pending:
+            data = self._pending + data
+        if self.plain_text_len is None:
+            if len(data) < 8:
+                self._pending = data
+                return b''
+            # called version in CryptManager
+            if data[0:4] != b'BF01':
+                raise UnsupportedFile('not a Tombo *.chi/*.chs file')
+            (self.plain_text_len,) = struct.unpack(FMT_STRUCT_4BYTE, data[4:8])
+            self._remaining = self.plain_text_len
+            data = data[8:]
+
+        usable = len(data) - len(data) % 8
+        self._pending = data[usable:]
+        if not usable:
+            return b''
+        enc_data = data[:usable]
+        plain_text = cbc_decrypt(self._cipher, enc_data, self._chain)
+        self._chain = enc_data[-8:]
+        if len(self._prefix) < 24:
+            needed = 24 - len(self._prefix)
+            self._prefix += plain_text[:needed]
+            plain_text = plain_text[needed:]
+        # anything past plain_text_len is padding
+        plain_text = plain_text[:self._remaining]
+        self._remaining -= len(plain_text)
+        self._md5.update(plain_text)
+        return plain_text
+
+    def finish(self):
+        """Call once all (encrypted) data has been fed in. Checks the md5 of the plaintext,
+        raises BadPassword on mismatch. Returns remaining plaintext bytes (currently always empty)
+        """
+        self.finished = True
+        if self.plain_text_len is None:
+            raise UnsupportedFile('not a Tombo *.chi/*.chs file')
+        if self._pending:
+            # This should not happen if it did this may be a corrupted file
+            raise UnsupportedFile('ExtraBytesFound during decryption')
+        if self._prefix[8:24] != self._md5.digest():
+            # password did not match (or truncated file), data is bogus
+            raise BadPassword('for %r' % ('stream'))
+        return b''
+
+
+def iter_decrypt(fileinfo, password, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Generator that decrypts a *.chi / *.chs file, yielding plaintext bytes as
+    ciphertext is read chunk_size bytes at a time. Uses constant memory.
+    Raises BadPassword at the end if the md5 of the plaintext does not match,
+    i.e. plaintext already yielded is NOT verified until the generator is exhausted.
+    See ChiDecoder.
+
+    fileinfo is either a filename (string) or a file-like object that reads binary bytes (caller is responsible for closing)
+    password is a (byte) string, i.e. not Unicode type
+    """
+    if password is None:
+        raise BadPassword('None passed in for password for file %r' % (fileinfo or 'file-like-object'))
+
+    decoder = ChiDecoder(password)
+    if isinstance(fileinfo, basestring):
+        enc_filename = fileinfo
+        in_file = open(enc_filename, 'rb')
+    else:
+        # assume it is a file-like object
+        in_file = fileinfo
+        enc_filename = None
+
+    try:
+        while True:
+            data = in_file.read(chunk_size)
+            if not data:
+                break
+            plain_text = decoder.feed(data)
+            if plain_text:
+                yield plain_text
+        try:
+            plain_text = decoder.finish()
+        except BadPassword:
+            # do not dump out password as that could be a security hole
+            raise BadPassword('Incorrect password for %r' % (enc_filename or 'file-like-object'))
+        if plain_text:
+            yield plain_text
+    finally:
+        if enc_filename:
+            in_file.close()
+
+
+class ChiEncoder(object):
+    """Push style (sans-I/O) encryption to Tombo *.chi / *.chs format.
+    The header and the first encrypted blocks contain the length and md5 of
+    the entire plaintext, so these need to be known up front.
+    Feed in plaintext, in chunks of any size, get back encrypted bytes. Uses constant memory.
+
+        encoder = ChiEncoder(password, plain_text_md5sum, plain_text_len)
+        for chunk in chunks:
+            out_file.write(encoder.feed(chunk))
+        out_file.write(encoder.finish())
+
+    finish() raises ChiIO if the plaintext fed in does not match
+    plain_text_md5sum / plain_text_len (output written so far is bogus).
+
+    password is a (byte) string, i.e. not Unicode type, or a cipher from CHI_cipher()
+    plain_text_md5sum is the (16 byte) md5 digest of the plaintext
+    salt is the 8 random bytes prefixed to the data, generated if omitted.
+    """
+
+    def __init__(self, password, plain_text_md5sum, plain_text_len, salt=None):
+        self._cipher = CHI_cipher(password)
+        self.plain_text_md5sum = plain_text_md5sum
+        self.plain_text_len = plain_text_len
+        self._header = b'BF01' + struct.pack(FMT_STRUCT_4BYTE, plain_text_len)  # output with first encrypted bytes
+        self._pending = (salt or os.urandom(8)) + plain_text_md5sum  # bytes not yet encrypted, less than a block after first feed()
+        self._chain = CBC_IV  # previous ciphertext block
+        self._md5 = md5checksum()
+        self._fed_len = 0
+        self.finished = False
+
+    def feed(self, data):
+        """Process plaintext bytes data, returns encrypted bytes, may be empty"""
+        if self.finished:
+            raise ValueError('feed() called after finish()')
+        if not isinstance(data, bytes):
+            raise ChiIO('Only support 8-bit (binary/bytes) plaintext (got %r). Encode first, see help(codecs).' % type(data))
+        self._md5.update(data)
+        self._fed_len += len(data)
+        data = self._pending + data
+        usable = len(data) - len(data) % 8
+        self._pending = data[usable:]
+        encrypted_data = b''
+        if usable:
+            encrypted_data = self._cipher.encrypt_cbc(data[:usable], self._chain)
+            self._chain = encrypted_data[-8:]
+        if self._header:
+            encrypted_data = self._header + encrypted_data
+            self._header = b''
+        return encrypted_data
+
+    def finish(self):
+        """Call once all plaintext has been fed in, returns final encrypted bytes"""
+        encrypted_data = self.feed(b'')
+        self.finished = True
+        if self._fed_len != self.plain_text_len or self._md5.digest() != self.plain_text_md5sum:
+            raise ChiIO('plaintext does not match length/md5 given, %d bytes expected %d' % (self._fed_len, self.plain_text_len))
+        if self._pending:
+            # Tombo partial last block, see encrypt_into_buffer()
+            tail = xor_bytes(self._pending, self._chain[:len(self._pending)])
+            encrypted_data += self._cipher.encrypt((tail * 8)[:8])
+        return encrypted_data
+
+
+def _stream_checksum(src, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Returns (md5 digest, length) of file-like object src, read from the current position to the end"""
+    m = md5checksum()
+    plain_text_len = 0
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        m.update(data)
+        plain_text_len += len(data)
+    return m.digest(), plain_text_len
+
+
+def encrypt_stream(src, dst, password, chunk_size=DEFAULT_CHUNK_SIZE, plain_text_md5sum=None, plain_text_len=None):
+    """Encrypts file-like object src (from its current position to the end) writing
+    a Tombo *.chi / *.chs file to file-like object dst. Uses constant memory.
+    Caller is responsible for closing src and dst.
+
+    As the md5 of the plaintext is stored in the first encrypted blocks, src
+    is read twice; first to generate the md5 (and length), then seek()'d back
+    and encrypted, one chunk_size at a time.
+    If the md5 (plain_text_md5sum) is known it can be passed in and src is read
+    once, so need not be seekable if plain_text_len is also passed in
+    (otherwise the length comes from fstat() or seek()).
+
+    password is a (byte) string, i.e. not Unicode type, or a cipher from CHI_cipher()
+    """
+    if plain_text_md5sum is None:
+        # first pass
+        start = src.tell()
+        plain_text_md5sum, plain_text_len = _stream_checksum(src, chunk_size)
+        src.seek(start)
+    elif plain_text_len is None:
+        start = src.tell()
+        try:
+            plain_text_len = os.fstat(src.fileno()).st_size - start
+        except (AttributeError, IOError, OSError, ValueError):
+            # no (real) file descriptor, e.g. BytesIO
+            src.seek(0, 2)
+            plain_text_len = src.tell() - start
+            src.seek(start)
+
+    encoder = ChiEncoder(password, plain_text_md5sum, plain_text_len)
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        dst.write(encoder.feed(data))
+    dst.write(encoder.finish())
+
+
+def write_encrypted_file(fileinfo, password, plaintext, use_mmap=False, skip_unchanged=False):
     """Writes an encrypted *.chi / *.chs file that could be read by Tombo. Parameter plaintext should be 8 bit string.
     Raises exceptions on failure (so caller is responsible for cleaning up incomplete out files).
     NOTE: if notes created with this routine are to be read in Tombo
@@ -568,8 +1971,34 @@ def write_encrypted_file(fileinfo, password, plaintext):
 
     fileinfo is either a filename (string) or a file-like object that writes binary bytes that be can written to (caller is responsible for closing)
     password is a (byte) string, i.e. not Unicode type
+    use_mmap - if fileinfo is a filename, preallocate the file (size is known up front)
+        and memory map it, ciphertext is then written directly into the map
+    skip_unchanged - if fileinfo is a filename, do not rewrite the file if it
+        already holds plaintext (same md5 and length, see is_unchanged())
 
+    Returns True if the file was written, False if skipped by skip_unchanged.
     """
+    if skip_unchanged and isinstance(fileinfo, basestring) and isinstance(plaintext, bytes):
+        if is_unchanged(fileinfo, password, md5checksum(plaintext).digest(), len(plaintext)):
+            return False
+
+    if use_mmap and isinstance(fileinfo, basestring):
+        if not isinstance(plaintext, bytes):
+            raise ChiIO('Only support 8-bit (binary/bytes) plaintext (got %r). Encode first, see help(codecs).' % type(plaintext))
+        out_size = encrypted_size(len(plaintext))
+        out_file = open(fileinfo, 'w+b')
+        try:
+            out_file.truncate(out_size)  # preallocate
+            mapped_file = mmap.mmap(out_file.fileno(), out_size)
+            try:
+                encrypt_into_buffer(CHI_cipher(password), plaintext, mapped_file)
+                mapped_file.flush()
+            finally:
+                mapped_file.close()
+        finally:
+            out_file.close()
+        return True
+
     cipher = PEP272LikeCipher(password)
     crypted_data = cipher.encrypt(plaintext)
 
@@ -598,6 +2027,137 @@ def write_encrypted_file(fileinfo, password, plaintext):
     if enc_filename is not None:
         # i.e. we opened the file so we need to close it
         out_file.close()
+    return True
+
+
+_replace_file = getattr(os, 'replace', os.rename)  # py2 has no os.replace(), rename() is atomic on POSIX only
+
+
+def _fsync_dir(dirname):
+    """Best effort fsync of directory dirname, so renames are durable (not possible on Windows)"""
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except (IOError, OSError):
+        return
+    try:
+        os.fsync(fd)
+    except (IOError, OSError):
+        pass
+    finally:
+        os.close(fd)
+
+
+def rekey_file(filename, old_password, new_password, chunk_size=DEFAULT_CHUNK_SIZE, fsync_dir=True):
+    """Re-encrypt *.chi / *.chs file filename (encrypted with old_password) with new_password.
+    Streams (constant memory) the ciphertext through decryption with old_password and
+    encryption with new_password into a temporary file in the same directory,
+    which is fsync'd and then renamed over filename. The md5 needed up
+    front by the encryption is taken from the existing file (see read_fingerprint())
+    and is verified by the decryption before the rename, so on any failure
+    (e.g. BadPassword) filename is left untouched and the temporary file removed.
+
+    old_password and new_password are (byte) strings, i.e. not Unicode type, or ciphers from CHI_cipher()
+    fsync_dir - also fsync the directory after the rename, rekey_tree() does this once per directory instead
+    """
+    decoder = ChiDecoder(old_password)
+    in_file = open(filename, 'rb')
+    try:
+        plain_text_len, plain_text_md5sum = read_fingerprint(in_file, old_password)
+        in_file.seek(0)
+        encoder = ChiEncoder(new_password, plain_text_md5sum, plain_text_len)
+        dirname, basename = os.path.split(os.path.abspath(filename))
+        fd, tmp_filename = tempfile.mkstemp(prefix='.' + basename + '.', suffix='.tmp', dir=dirname)
+        try:
+            out_file = os.fdopen(fd, 'wb')
+            try:
+                while True:
+                    data = in_file.read(chunk_size)
+                    if not data:
+                        break
+                    out_file.write(encoder.feed(decoder.feed(data)))
+                try:
+                    plain_text = decoder.finish()
+                except BadPassword:
+                    raise BadPassword('Incorrect password for %r' % filename)
+                out_file.write(encoder.feed(plain_text))
+                out_file.write(encoder.finish())
+                out_file.flush()
+                os.fsync(out_file.fileno())
+            finally:
+                out_file.close()
+            os.chmod(tmp_filename, stat.S_IMODE(os.fstat(in_file.fileno()).st_mode))  # mkstemp() files are owner only
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+    finally:
+        in_file.close()
+    _replace_file(tmp_filename, filename)
+    if fsync_dir:
+        _fsync_dir(dirname)
+
+
+def _rekey_tree_batch(filenames, old_key_state, new_key_state):
+    """Process pool worker, re-keys a list of filenames.
+    Returns list of (filename, exception) tuples, exception is None on success"""
+    old_cipher, new_cipher = CHI_cipher(old_key_state), CHI_cipher(new_key_state)  # key cache hit after the first batch
+    results = []
+    dirnames = set()
+    for filename in filenames:
+        try:
+            rekey_file(filename, old_cipher, new_cipher, fsync_dir=False)
+            dirnames.add(os.path.dirname(os.path.abspath(filename)))
+            results.append((filename, None))
+        except Exception as info:
+            results.append((filename, info))
+    for dirname in dirnames:
+        _fsync_dir(dirname)
+    return results
+
+
+def imap_rekey_tree(root, old_password, new_password, jobs=None, extensions=CHI_EXTENSIONS):
+    """Generator, re-encrypts every *.chi / *.chs file under directory root
+    with new_password (see rekey_file()) using a pool of jobs processes
+    (default is the number of CPUs). Yields (filename, exception) tuples as
+    files complete (NOT in order), exception is None on success, otherwise
+    (e.g. BadPassword, UnsupportedFile) the file was left untouched.
+    Failures do not stop other files being processed.
+
+    See imap_decrypt_tree() for batching, and process pool notes.
+    """
+    old_cipher, new_cipher = CHI_cipher(old_password), CHI_cipher(new_password)
+    files = list(iter_tree_files(root, extensions))
+    if jobs is None:
+        jobs = cpu_count() or 1
+    if ProcessPoolExecutor is None or jobs <= 1 or len(files) <= 1:
+        for batch in _batch_by_size(files, 1):
+            for result in _rekey_tree_batch(batch, old_cipher, new_cipher):
+                yield result
+        return
+
+    executor = ProcessPoolExecutor(jobs)
+    futures = []
+    try:
+        old_key_state, new_key_state = old_cipher.export_key_state(), new_cipher.export_key_state()
+        for batch in _batch_by_size(files, jobs):
+            futures.append(executor.submit(_rekey_tree_batch, batch, old_key_state, new_key_state))
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
+    finally:
+        for future in futures:
+            future.cancel()  # generator closed early
+        executor.shutdown(wait=True)
+
+
+def rekey_tree(root, old_password, new_password, jobs=None, extensions=CHI_EXTENSIONS):
+    """Change the password of every *.chi / *.chs file under directory root, see imap_rekey_tree().
+    Returns dictionary of filename to None (re-keyed) or to the exception
+    (e.g. BadPassword, UnsupportedFile) for files that were left untouched.
+    """
+    result = {}
+    for filename, exception in imap_rekey_tree(root, old_password, new_password, jobs=jobs, extensions=extensions):
+        result[filename] = exception
+    return result
 
 
 def dumb_unix2dos(in_str):
@@ -608,15 +2168,62 @@ def dumb_unix2dos(in_str):
 
 
 ## Consider using filelike from http://cheeseshop.python.org/pypi/filelike/
-class ChiAsFile(object):
+class ChiAsFile(io.RawIOBase):
     """File like object around CHI/CHS encrypted files for reading and writing.
-    Partial seek() support for read operations ONLY.
-    Currently expects byte values for write and returns byte values for read"""
+    seek()/tell() support for read operations ONLY.
+    Currently expects byte values for write and returns byte values for read
+
+    A (raw, binary) io.RawIOBase so supports readinto(), readline(),
+    iteration and with statements, and can be wrapped for buffering/text;
+
+        with io.TextIOWrapper(ChiAsFile(filename, password), encoding='utf-8') as f:
+            for line in f:
+                ...
+
+    Read mode is lazy, nothing is read until the first read()/seek()/tell().
+    CBC decryption of a block only needs that ciphertext block and the
+    previous one, so reads only decrypt the blocks they touch; small reads
+    are served from an LRU of decrypted chunks (read_chunk_size bytes each).
+    Read mode needs a seekable fileptr (or a filename, opened on first use).
+
+    NOTE the md5 covers the entire plaintext. Reading sequentially from
+    the start to the end of the file checks the md5 at no extra cost
+    (BadPassword is raised by the read() that reaches the end), otherwise
+    data is unverified until verify() is called. verify=True calls verify()
+    on close().
+
+    Write modes buffer the plaintext in memory up to spool_size bytes,
+    beyond that it spills over to an (anonymous) temporary file. close()
+    then encrypts from the buffer a chunk at a time, so memory usage is
+    bounded for large notes.
+
+    write_behind=True makes close() return immediately, encryption and
+    writing happen in a background thread; close() returns a
+    WriteBehindResult, call result() to wait and check for errors. Pending
+    writes are flushed at process exit. In write modes fileptr may be a
+    filename, otherwise the caller must not close fileptr until the write has
+    completed.
+
+    skip_unchanged=True compares the md5 and length of the new plaintext with
+    the existing file before writing (see is_unchanged()) and leaves the file
+    untouched if they match; '+' mode with no write() calls never rewrites.
+    'w' mode can only compare when fileptr is a filename (a file object opened
+    for writing has already been truncated). close() returns True if the file
+    was written, False if skipped (in write_behind mode the WriteBehindResult's
+    result() returns this).
+    """
 
-    def __init__(self, fileptr, password, mode=None):
+    read_chunk_size = 4 * 1024  # multiple of 8 (the block size)
+    read_cache_entries = 16
+
+    def __init__(self, fileptr, password, mode=None, verify=False, spool_size=DEFAULT_SPOOL_SIZE, write_behind=False, skip_unchanged=False):
         self._fileptr = fileptr
         self._password = password
-        self._bufferedfileptr = FakeFile()
+        self._write_behind = write_behind
+        self._skip_unchanged = skip_unchanged
+        self._modified = False
+        self._bufferedfileptr = None
+        self._verify_on_close = verify
         mode = mode or 'r'
         if 'w' in mode:
             self._mode = 'w'
@@ -627,58 +2234,398 @@ class ChiAsFile(object):
         else:
             # TODO "a" append mode (+), implications for seek()?
             raise NotImplemented('mode=%r' % mode)
-        if self._mode in ('r', '+'):
-            self._read_from_file()  # FIXME make this lazy, rather than at init time
+        if self._mode in ('w', '+'):
+            self._bufferedfileptr = tempfile.SpooledTemporaryFile(max_size=spool_size)
+            self._md5 = md5checksum()  # 'w' mode only ever appends, so can hash as data is written
+            self._plain_text_len = 0
+        if self._mode == '+':
+            self._read_from_file()
+        elif self._mode == 'r':
+            self._cipher = None  # not None once header has been read, see _open()
+            self._opened_fileptr = False  # True if _open() opened (and close() should close) a filename
+            self._chunks = OrderedDict()  # chunk number -> plaintext bytes
+            self._pos = 0
+            self._verified = False
+
+    def readable(self):
+        return self._mode in ('r', '+')
+
+    def getvalue(self):
+        """Deprecated, returns the entire plaintext (bytes), the file position is unchanged.
+        Use seek(0) and read() instead.
+        (ChiAsFile used to pass unknown attributes through to an in memory buffer.)
+        """
+        warnings.warn('ChiAsFile.getvalue() is deprecated, use seek(0) and read()', DeprecationWarning, stacklevel=2)
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if self._mode == 'r':
+            position = self.tell()
+            self.seek(0)
+            try:
+                return self.read()
+            finally:
+                self.seek(position)
+        position = self._bufferedfileptr.tell()
+        self._bufferedfileptr.seek(0)
+        try:
+            return self._bufferedfileptr.read()
+        finally:
+            self._bufferedfileptr.seek(position)
+
+    def __del__(self):
+        # io.IOBase would close() here, i.e. encrypt and write (or verify) during
+        # garbage collection. No file I/O is done in finalization; like before
+        # ChiAsFile was an io.RawIOBase, writes are discarded unless close() is called
+        if getattr(self, '_mode', None) is None or self.closed:
+            return
+        try:
+            if self._mode == 'r':
+                self._chunks.clear()
+                if self._opened_fileptr:
+                    self._fileptr.close()
+            else:
+                self._bufferedfileptr.close()  # discard
+        finally:
+            io.RawIOBase.close(self)
 
-    def __getattr__(self, attr):
-        if self.__dict__.has_key(attr):
-            return self.__dict__[attr]
-        else:
-            return getattr(self._bufferedfileptr, attr)
+    def writable(self):
+        return self._mode in ('w', '+')
+
+    def seekable(self):
+        return self._mode == 'r'
 
     def _read_from_file(self):
         # TODO this may be the start of allowing read and write support in the same session
-        plain_text = read_encrypted_file(self._fileptr, self._password)
-        self._bufferedfileptr = FakeFile(plain_text)
+        for plain_text in iter_decrypt(self._fileptr, self._password):
+            self._bufferedfileptr.write(plain_text)
+        self._bufferedfileptr.seek(0)
+
+    def _open(self):
+        """Read mode, (lazily) read header and check the file size"""
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if self._cipher is not None:
+            return
+        filename = None
+        if isinstance(self._fileptr, basestring):
+            filename = self._fileptr
+            self._fileptr = open(filename, 'rb')
+        fileptr = self._fileptr
+        try:
+            self._base = fileptr.tell()
+            header = fileptr.read(8 + 24)
+            if len(header) < 8 or header[0:4] != b'BF01':
+                raise UnsupportedFile('not a Tombo *.chi/*.chs file')
+            (self.plain_text_len,) = struct.unpack(FMT_STRUCT_4BYTE, header[4:8])
+            fileptr.seek(0, 2)
+            file_size = fileptr.tell() - self._base
+            if file_size < encrypted_size(self.plain_text_len) or file_size % 8:
+                raise UnsupportedFile('truncated or corrupt Tombo *.chi/*.chs file')
+        except BaseException:
+            if filename is not None:
+                # do not leak the handle, a retry re-opens from the start
+                fileptr.close()
+                self._fileptr = filename
+            raise
+        self._opened_fileptr = filename is not None
+
+        self._cipher = CHI_cipher(self._password)
+        self._md5sum = cbc_decrypt(self._cipher, header[8:])[8:24]
+        self._md5 = md5checksum()
+        self._md5_pos = 0  # plaintext bytes (read sequentially from start) included in _md5
+
+    def _decrypt_range(self, start, end):
+        """Returns plaintext bytes [start, end), start must be block aligned and end <= plain_text_len"""
+        block_end = (end + 7) // 8 * 8
+        # previous ciphertext block is the IV, the md5 is the block before the plaintext
+        self._fileptr.seek(self._base + 8 + 16 + start)
+        enc_data = self._fileptr.read(8 + block_end - start)
+        if len(enc_data) != 8 + block_end - start:
+            raise UnsupportedFile('truncated Tombo *.chi/*.chs file')
+        return cbc_decrypt(self._cipher, enc_data[8:], enc_data[:8])[:end - start]
+
+    def _get_chunk(self, chunk_num):
+        chunks = self._chunks
+        try:
+            plain_text = chunks.pop(chunk_num)
+        except KeyError:
+            start = chunk_num * self.read_chunk_size
+            plain_text = self._decrypt_range(start, min(start + self.read_chunk_size, self.plain_text_len))
+            if len(chunks) >= self.read_cache_entries:
+                chunks.popitem(last=False)
+        chunks[chunk_num] = plain_text  # most recently used
+        return plain_text
+
+    def _check_md5(self, pos, plain_text):
+        """Update md5 for sequential reads, raise BadPassword at end if mismatch"""
+        if pos != self._md5_pos or self._verified:
+            return
+        self._md5.update(plain_text)
+        self._md5_pos += len(plain_text)
+        if self._md5_pos == self.plain_text_len:
+            if self._md5.digest() != self._md5sum:
+                raise BadPassword('for %r' % ('file-like-object',))
+            self._verified = True
 
     def read(self, size=None):
         if self._mode == 'w':
             raise IOError(
                 'file was write, and then read issued. read and write are mutually exclusive operations'
             )
-        # do we need this if?
-        if size is None:
-            return self._bufferedfileptr.read()
+        if self._mode != 'r':
+            # do we need this if?
+            if size is None:
+                return self._bufferedfileptr.read()
+            else:
+                return self._bufferedfileptr.read(size)
+
+        self._open()
+        pos = self._pos
+        end = self.plain_text_len
+        if size is not None and size >= 0:
+            end = min(end, pos + size)
+        if pos >= end:
+            return b''
+        chunk_size = self.read_chunk_size
+        first_chunk, last_chunk = pos // chunk_size, (end - 1) // chunk_size
+        if last_chunk - first_chunk > 1:
+            # large read, decrypt covering blocks with one backend call (bypass cache)
+            block_start = pos - pos % 8
+            plain_text = self._decrypt_range(block_start, end)[pos - block_start:]
         else:
-            return self._bufferedfileptr.read(size)
-
-    def seek(self, offset):  # FIXME `whence` support
+            plain_text = b''.join(self._get_chunk(x) for x in range(first_chunk, last_chunk + 1))
+            offset = pos - first_chunk * chunk_size
+            plain_text = plain_text[offset:offset + end - pos]
+        self._pos = end
+        self._check_md5(pos, plain_text)
+        return plain_text
+
+    def read1(self, size=-1):
+        # not part of RawIOBase, but allows io.TextIOWrapper without io.BufferedReader (required by py2)
+        return self.read(size)
+
+    def readinto(self, b):
+        plain_text = self.read(len(b))
+        b[:len(plain_text)] = plain_text
+        return len(plain_text)
+
+    def readline(self, size=-1):
+        if self._mode != 'r':
+            if self._mode == 'w':
+                raise IOError(
+                    'file was write, and then read issued. read and write are mutually exclusive operations'
+                )
+            return self._bufferedfileptr.readline(size)
+
+        self._open()
+        result = []
+        chunk_size = self.read_chunk_size
+        pos = self._pos
+        end = self.plain_text_len
+        if size is not None and size >= 0:
+            end = min(end, pos + size)
+        while pos < end:
+            chunk_num = pos // chunk_size
+            chunk_start = chunk_num * chunk_size
+            plain_text = self._get_chunk(chunk_num)
+            line_end = plain_text.find(b'\n', pos - chunk_start, end - chunk_start) + 1
+            found = line_end > 0
+            if not found:
+                line_end = min(len(plain_text), end - chunk_start)
+            plain_text = plain_text[pos - chunk_start:line_end]
+            self._check_md5(pos, plain_text)
+            result.append(plain_text)
+            pos += len(plain_text)
+            if found:
+                break
+        self._pos = pos
+        return b''.join(result)
+
+    def seek(self, offset, whence=0):
         if self._mode != 'r':
             raise IOError(
                 'seek issued for non-read operation'
             )
-        return self._bufferedfileptr.seek(offset)
+        self._open()
+        if whence == 0:
+            pos = offset
+        elif whence == 1:
+            pos = self._pos + offset
+        elif whence == 2:
+            pos = self.plain_text_len + offset
+        else:
+            raise ValueError('invalid whence (%r, should be 0, 1 or 2)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %r' % pos)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        if self._mode != 'r':
+            return self._bufferedfileptr.tell()
+        self._open()
+        return self._pos
+
+    def verify(self):
+        """Read mode, check md5 of the entire plaintext, raises BadPassword on mismatch.
+        Decrypts the file in chunks (constant memory), does not change the position.
+        Returns True"""
+        self._open()
+        if not self._verified:
+            m = md5checksum()
+            for start in range(0, self.plain_text_len, DEFAULT_CHUNK_SIZE):
+                m.update(self._decrypt_range(start, min(start + DEFAULT_CHUNK_SIZE, self.plain_text_len)))
+            if m.digest() != self._md5sum:
+                raise BadPassword('for %r' % ('file-like-object',))
+            self._verified = True
+        return True
 
     def write(self, str_of_bytes):
         if self._mode == 'r':
             raise IOError(
                 'file was read, and then write issued. read and write are mutually exclusive operations'
             )
-        return self._bufferedfileptr.write(str_of_bytes)
+        self._bufferedfileptr.write(str_of_bytes)
+        self._modified = True
+        if self._mode == 'w':
+            self._md5.update(str_of_bytes)
+            self._plain_text_len += len(str_of_bytes)
+        return len(str_of_bytes)
 
     def close(self, *args, **kwargs):
         ## do we need to call this in __del__?
+        # Write modes return True if written, False if skipped (skip_unchanged), in write_behind mode a WriteBehindResult
+        if self._mode == 'r':
+            if self.closed:
+                return
+            try:
+                if self._verify_on_close:
+                    self.verify()
+            finally:
+                io.RawIOBase.close(self)
+                self._chunks.clear()
+                if self._opened_fileptr:
+                    self._fileptr.close()
+            return
+        if self.closed:
+            return
+        io.RawIOBase.close(self)
         if self._mode != 'r':
             # i.e writable file
-            plain_text = self._bufferedfileptr.getvalue()
-            if self._mode == '+':
-                self._fileptr.seek(0)
-                self._fileptr.truncate()
-            write_encrypted_file(self._fileptr, self._password, plain_text)
-        # self._fileptr.close() # is this right?
-        self._bufferedfileptr.close()
+            spool = self._bufferedfileptr
+            md5sum = self._md5.digest() if self._mode == 'w' else None
+            if self._write_behind:
+                # hand the buffer over to the background thread, replace with a closed file so further writes fail
+                self._bufferedfileptr = FakeFile()
+                self._bufferedfileptr.close()
+                return submit_write_behind(self._write_spool, spool, md5sum, self._plain_text_len)
+            return self._write_spool(spool, md5sum, self._plain_text_len)
         ## TODO disallow more writes/closes....
 
+    def _write_spool(self, spool, md5sum, plain_text_len):
+        """Encrypt buffer spool into fileptr, closes spool.
+        Returns True if written, False if skipped (skip_unchanged)"""
+        try:
+            spool.seek(0)
+            if self._skip_unchanged:
+                if self._mode == '+':
+                    if not self._modified:
+                        return False
+                    md5sum, plain_text_len = _stream_checksum(spool)
+                    spool.seek(0)
+                    if not isinstance(self._fileptr, basestring):
+                        self._fileptr.seek(0)
+                if (self._mode == '+' or isinstance(self._fileptr, basestring)) and is_unchanged(self._fileptr, self._password, md5sum, plain_text_len):
+                    return False
+            if isinstance(self._fileptr, basestring):
+                out_file = open(self._fileptr, 'wb')
+            else:
+                out_file = self._fileptr
+            try:
+                if self._mode == '+':
+                    out_file.seek(0)
+                    out_file.truncate()
+                    encrypt_stream(spool, out_file, self._password, plain_text_md5sum=md5sum, plain_text_len=plain_text_len)  # if md5sum is None, two passes, first for md5
+                else:
+                    encrypt_stream(spool, out_file, self._password, plain_text_md5sum=md5sum, plain_text_len=plain_text_len)
+            finally:
+                if out_file is not self._fileptr:
+                    out_file.close()
+                # self._fileptr.close() # is this right?
+        finally:
+            spool.close()
+        return True
+
+
+class WriteBehindResult(object):
+    """Handle for a write queued by submit_write_behind(), e.g. returned
+    by ChiAsFile.close() in write_behind mode.
+    Similar to concurrent.futures.Future; done(), result() and exception()
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._exception = None
+        self._result = None
+
+    def done(self):
+        """Returns True if the write has finished (successfully or not)"""
+        return self._event.is_set()
+
+    def exception(self, timeout=None):
+        """Wait for the write, returns the exception raised by it (None if successful).
+        Raises ChiIO if timeout (seconds) expires first"""
+        if not self._event.wait(timeout) and not self._event.is_set():  # py2.6 wait() returns None
+            raise ChiIO('timed out waiting for write-behind')
+        return self._exception
+
+    def result(self, timeout=None):
+        """Wait for the write, re-raising any exception raised by it,
+        otherwise returns the write's return value.
+        Raises ChiIO if timeout (seconds) expires first"""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+_write_behind_lock = threading.Lock()
+_write_behind_queue = None  # created, along with worker thread, on first use
+
+
+def _write_behind_worker(work_queue):
+    while True:
+        func, args, result = work_queue.get()
+        try:
+            result._result = func(*args)
+        except BaseException as info:
+            result._exception = info
+        result._event.set()
+        work_queue.task_done()
+
+
+def submit_write_behind(func, *args):
+    """Queue func(*args) for the (single) write-behind thread, writes happen in order.
+    Returns WriteBehindResult. Queued writes are flushed at process exit, see flush_write_behind()
+    """
+    global _write_behind_queue
+    with _write_behind_lock:
+        if _write_behind_queue is None:
+            _write_behind_queue = Queue()
+            worker = threading.Thread(target=_write_behind_worker, args=(_write_behind_queue,), name='chi_io-write-behind')
+            worker.daemon = True
+            worker.start()
+            atexit.register(flush_write_behind)
+    result = WriteBehindResult()
+    _write_behind_queue.put((func, args, result))
+    return result
+
+
+def flush_write_behind():
+    """Blocks until all queued write-behind writes have completed (successfully or not)"""
+    if _write_behind_queue is not None:
+        _write_behind_queue.join()
+
 
 def demo_test():
     """Examples of use with some error handling"""
@@ -28,7 +28,7 @@ def main(argv=None):
         print(sys.version)
         print(chi_io.implementation)
 
-    usage = "usage: %prog [options] in_filename"
+    usage = "usage: %prog [options] in_filename\n       %prog [options] --rekey directory"
     parser = OptionParser(usage=usage, version="%prog 1.0")
     parser.add_option("-o", "--output", dest="out_filename", default='-',
                         help="write output to FILE", metavar="FILE")
@@ -39,6 +39,9 @@ def main(argv=None):
     parser.add_option("-c", "--codec", help="File encoding", default='utf-8')
     parser.add_option("-p", "--password", help="password, if omitted but OS env CHI_PASSWORD is set use that, if missing prompt")
     parser.add_option("-P", "--password_file", help="file name where password is to be read from, trailing blanks are ignored")
+    parser.add_option("-r", "--rekey", action="store_true", help="change the password of all *.chi / *.chs files under directory in_filename")
+    parser.add_option("-n", "--new_password", help="rekey new password, if omitted but OS env CHI_NEW_PASSWORD is set use that, if missing prompt")
+    parser.add_option("-j", "--jobs", type="int", help="rekey number of processes to use, default is number of CPUs")
     parser.add_option("-v", "--verbose", action="store_true")
     parser.add_option("-s", "--silent", help="if specified do not warn about stdin using", action="store_false", default=True)
     (options, args) = parser.parse_args(argv[1:])
@@ -76,6 +79,32 @@ def main(argv=None):
     if not isinstance(password, bytes):
         password = password.encode('us-ascii')
 
+    if options.rekey:
+        if in_filename == '-':
+            usage()
+            return 1
+        new_password = options.new_password or os.environ.get('CHI_NEW_PASSWORD')
+        if not new_password:
+            new_password = getpass.getpass("New password:")
+            if new_password != getpass.getpass("New password (again):"):
+                print("new passwords do not match")
+                return 1
+        if not isinstance(new_password, bytes):
+            new_password = new_password.encode('us-ascii')
+        rekeyed, failed = 0, 0
+        for filename, exception in chi_io.imap_rekey_tree(in_filename, password, new_password, jobs=options.jobs):
+            if exception is None:
+                rekeyed += 1
+                if verbose:
+                    print(filename)
+            else:
+                failed += 1
+                print("%s failed, left unchanged. %r" % (filename, exception))
+        print("%d files rekeyed, %d failed" % (rekeyed, failed))
+        if failed:
+            return 1
+        return 0
+
     if in_filename == '-':
         if is_py3:
             in_file = sys.stdin.buffer
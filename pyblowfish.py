@@ -101,7 +101,15 @@ intro = """
 from array    import array
 from time     import time
 from copy     import deepcopy
-from struct   import pack, unpack
+from struct   import pack, unpack, unpack_from, calcsize
+try:
+    from struct import iter_unpack
+except ImportError:
+    # Python 2
+    def iter_unpack(fmt, buffer):
+        size = calcsize(fmt)
+        for offset in range(0, len(buffer), size):
+            yield unpack_from(fmt, buffer, offset)
 from binascii import hexlify, unhexlify
 
 try:
@@ -117,6 +125,8 @@ py_maj_version = sys.version_info[0]
 
 # --------------------------------------------------------------
 
+KEY_STATE_SIZE = (18 + 4 * 256) * 4   # bytes, see export_key_state()
+
 class Blowfish(object):
     N       = 16
     counter = b''
@@ -434,6 +444,34 @@ class Blowfish(object):
         self.set_counter(nonce)     # only necessary if CTR mode
     
     
+    def export_key_state(self):
+        """ returns the expanded key, i.e. P and S after the key 
+            schedule, as a bytestring of 18 + 4*256 big-endian 
+            4-byte words.  See from_key_state()
+        """
+        words = self.P + self.S[0] + self.S[1] + self.S[2] + self.S[3]
+        return pack('>%dL' % len(words), *words)
+    
+    
+    @classmethod
+    def from_key_state(cls, key_state, nonce=b''):
+        """ creates an instance of Blowfish from the result of 
+            export_key_state() without running the (slow) key 
+            schedule.
+            
+            key_state is a bytestring of 18 + 4*256 4-byte words
+            nonce is an optional bytestring of up to 8 bytes
+        """
+        if len(key_state) != KEY_STATE_SIZE:
+            raise ValueError('key_state length %d is not %d' % (len(key_state), KEY_STATE_SIZE))
+        words = unpack('>%dL' % (KEY_STATE_SIZE // 4), key_state)
+        self = cls.__new__(cls)
+        self.P = list(words[:18])
+        self.S = tuple([list(words[18 + i * 256:18 + (i + 1) * 256]) for i in range(4)])
+        self.set_counter(nonce)     # only necessary if CTR mode
+        return self
+    
+    
     def encipher_block(self, block):
         """ encrypt a single block of data
             
@@ -474,6 +512,100 @@ class Blowfish(object):
         return int2fourByte(xl) + int2fourByte(xr)
     
     
+    def encrypt_ecb(self, data):
+        """ encrypt data in ECB mode
+            
+            data is a bytestring (or bytes-like object) of any 
+            multiple of 8 bytes, returns a bytestring
+        """
+        return self._ecb(data, self.P)
+    
+    
+    def decrypt_ecb(self, data):
+        """ decrypt data in ECB mode
+            
+            data is a bytestring (or bytes-like object) of any 
+            multiple of 8 bytes, returns a bytestring
+        """
+        return self._ecb(data, self.P[::-1])
+    
+    
+    def _ecb(self, data, P):
+        """ multi-block Blowfish, decryption is encryption with 
+            P reversed.  Rounds are unrolled and P and S are 
+            bound to locals to avoid attribute and index lookups
+        """
+        if len(data) % 8:
+            raise ValueError('data length %d is not a multiple of 8' % len(data))
+        p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, p17 = P
+        S0, S1, S2, S3 = self.S
+        result = []
+        append = result.append
+        for xl, xr in iter_unpack('>2L', data):
+            xl ^= p0
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p1
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p2
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p3
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p4
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p5
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p6
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p7
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p8
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p9
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p10
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p11
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p12
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p13
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p14
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p15
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p16
+            xr ^= p17
+            append(xr)
+            append(xl)
+        return pack('>%dL' % len(result), *result)
+    
+    
+    def encrypt_cbc(self, data, iv):
+        """ encrypt data in CBC mode
+            
+            data is a bytestring (or bytes-like object) of any 
+            multiple of 8 bytes, iv is an 8 byte bytestring. 
+            Returns a bytestring
+        """
+        if len(data) % 8:
+            raise ValueError('data length %d is not a multiple of 8' % len(data))
+        p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, p17 = self.P
+        S0, S1, S2, S3 = self.S
+        result = []
+        append = result.append
+        chain_l, chain_r = unpack('>2L', iv)
+        for xl, xr in iter_unpack('>2L', data):
+            xl ^= chain_l
+            xr ^= chain_r
+            xl ^= p0
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p1
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p2
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p3
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p4
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p5
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p6
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p7
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p8
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p9
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p10
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p11
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p12
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p13
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p14
+            xr ^= (((S0[xl >> 24] + S1[xl >> 16 & 0xFF]) ^ S2[xl >> 8 & 0xFF]) + S3[xl & 0xFF]) & 0xFFFFFFFF ^ p15
+            xl ^= (((S0[xr >> 24] + S1[xr >> 16 & 0xFF]) ^ S2[xr >> 8 & 0xFF]) + S3[xr & 0xFF]) & 0xFFFFFFFF ^ p16
+            xr ^= p17
+            append(xr)
+            append(xl)
+            chain_l, chain_r = xr, xl
+        return pack('>%dL' % len(result), *result)
+    
+    
     def _F(self, x):
         "scramble things well"
         a = (x & 0xFF000000) >> 24
@@ -807,6 +939,47 @@ if __name__ == '__main__':
         
         print('      %d tests failed out of %d tests performed' % 
                                                     (fails, tests))
+        
+        # multi-block entry points must agree with the single 
+        # block ones
+        bf = Blowfish(b'turnkey')
+        data = unhexlify(''.join(crypt for key, clear, crypt in 
+                                    testset1).encode('utf-8'))
+        single = b''.join([bf.encipher_block(data[i:i+8]) 
+                                for i in range(0, len(data), 8)])
+        if (bf.encrypt_ecb(data) != single or 
+                bf.decrypt_ecb(single) != data):
+            print('      *** failure:  multi-block ECB')
+    
+    
+    if 1:
+        # throughput, blocks/sec for the running interpreter
+        print('')
+        print('    Throughput:')
+        bf = Blowfish(b'turnkey')
+        nblocks = 20000
+        data = b'\0' * 8 * nblocks
+        
+        start = time()
+        for i in range(0, len(data), 8):
+            bf.encipher_block(data[i:i+8])
+        print('      encipher_block %10.0f blocks/sec' % 
+                                    (nblocks / (time() - start)))
+        
+        start = time()
+        bf.encrypt_ecb(data)
+        print('      encrypt_ecb    %10.0f blocks/sec' % 
+                                    (nblocks / (time() - start)))
+        
+        start = time()
+        bf.decrypt_ecb(data)
+        print('      decrypt_ecb    %10.0f blocks/sec' % 
+                                    (nblocks / (time() - start)))
+        
+        start = time()
+        bf.encrypt_cbc(data, b'\0' * 8)
+        print('      encrypt_cbc    %10.0f blocks/sec' % 
+                                    (nblocks / (time() - start)))
     print('')
         
 
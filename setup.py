@@ -44,7 +44,7 @@ setup(
     long_description=long_description,
     long_description_content_type='text/markdown',
     #packages=['chi_io'],  # not implemented yet
-    py_modules=['chi_io', 'pyblowfish'],
+    py_modules=['chi_io', 'chi_async', 'pyblowfish'],  # chi_async is Python 3.6+ only
     #data_files=[('.', [readme_filename])],  # does not work :-( ALso tried setup.cfg [metadata]\ndescription-file = README.md # Maybe try include_package_data = True and a MANIFEST.in?
     classifiers=[  # See http://pypi.python.org/pypi?%3Aaction=list_classifiers
         'Development Status :: 4 - Beta',
@@ -10,10 +10,18 @@ Sample usage:
 
 """
 
+import gc
 import os
+import mmap
+import shutil
 import sys
 import string
 import codecs
+import io
+import tempfile
+import threading
+import time
+import warnings
 
 try:
     if sys.version_info < (2, 3):
@@ -44,6 +52,12 @@ except ImportError:
         using_cstring = False
 
 import chi_io
+import pyblowfish
+try:
+    import chi_async
+except (ImportError, SyntaxError):
+    # py2 (and < 3.6), no async/await
+    chi_async = None
 
 """
 Missing tests for:
@@ -111,6 +125,104 @@ class TestChiIOUtil(TestChiIOBase):
         )
 
 
+class TestKeyCache(TestChiIOBase):
+    def test_chi_cipher_cached(self):
+        test_password = b'mypassword'
+        chi_io.clear_key_cache()
+        before = chi_io.key_cache.stats()
+
+        cipher = chi_io.CHI_cipher(test_password)
+        self.assertTrue(cipher is chi_io.CHI_cipher(test_password))
+        self.assertTrue(cipher is chi_io.CHI_cipher(u'mypassword'))
+        self.assertFalse(cipher is chi_io.CHI_cipher(b'otherpassword'))
+
+        after = chi_io.key_cache.stats()
+        self.assertEqual(2, after['hits'] - before['hits'])
+        self.assertEqual(2, after['misses'] - before['misses'])
+
+        chi_io.clear_key_cache()
+        self.assertEqual(0, chi_io.key_cache.stats()['entries'])
+        self.assertFalse(cipher is chi_io.CHI_cipher(test_password))
+
+    def test_lru_eviction(self):
+        cache = chi_io.KeyCache(max_entries=2)
+        cache.put(b'a', 'cipher a')
+        cache.put(b'b', 'cipher b')
+        self.assertEqual('cipher a', cache.get(b'a'))  # b is now least recently used
+        cache.put(b'c', 'cipher c')
+        self.assertEqual(None, cache.get(b'b'))
+        self.assertEqual('cipher a', cache.get(b'a'))
+        self.assertEqual('cipher c', cache.get(b'c'))
+        self.assertEqual({'hits': 3, 'misses': 1, 'evictions': 1, 'entries': 2}, cache.stats())
+
+    def test_disabled(self):
+        cache = chi_io.KeyCache(max_entries=0)
+        cache.put(b'a', 'cipher a')
+        self.assertEqual(None, cache.get(b'a'))
+
+    def test_ttl(self):
+        cache = chi_io.KeyCache(ttl=0.01)
+        cache.put(b'a', 'cipher a')
+        time.sleep(0.05)
+        self.assertEqual(None, cache.get(b'a'))
+        self.assertEqual(0, cache.stats()['entries'])
+
+
+class TestPyBlowfish(TestChiIOBase):
+    ## pure python Blowfish multi-block engine, regardless of chi_io.implementation
+    # key, clear, crypt - from http://www.schneier.com/code/vectors.txt
+    vectors = (
+        ('0000000000000000', '0000000000000000', '4EF997456198DD78'),
+        ('FFFFFFFFFFFFFFFF', 'FFFFFFFFFFFFFFFF', '51866FD5B85ECB8A'),
+        ('0123456789ABCDEF', '1111111111111111', '61F9C3802281B096'),
+        ('FEDCBA9876543210', '0123456789ABCDEF', '0ACEAB0FC6A0A28D'),
+    )
+
+    def test_ecb_vectors(self):
+        for key, clear, crypt in self.vectors:
+            bf = pyblowfish.Blowfish(codecs.decode(key, 'hex'))
+            clear, crypt = codecs.decode(clear, 'hex'), codecs.decode(crypt, 'hex')
+            self.assertEqual(crypt, bf.encrypt_ecb(clear))
+            self.assertEqual(clear, bf.decrypt_ecb(crypt))
+
+    def test_multi_block(self):
+        bf = pyblowfish.Blowfish(b'mypassword')
+        test_data = b"this is just a small piece of text, 48 bytes...."
+        single = b''.join([bf.encipher_block(test_data[i:i + 8]) for i in range(0, len(test_data), 8)])
+        self.assertEqual(single, bf.encrypt_ecb(test_data))
+        self.assertEqual(test_data, bf.decrypt_ecb(single))
+        self.assertEqual(b'', bf.encrypt_ecb(b''))
+        self.assertRaises(ValueError, bf.encrypt_ecb, test_data[:-1])
+
+    def test_encrypt_cbc(self):
+        bf = pyblowfish.Blowfish(b'mypassword')
+        test_data = b"this is just a small piece of text, 48 bytes...."
+        crypted_data = bf.encrypt_cbc(test_data, chi_io.CBC_IV)
+        previous_block = chi_io.CBC_IV
+        for i in range(0, len(test_data), 8):
+            block = crypted_data[i:i + 8]
+            self.assertEqual(test_data[i:i + 8], chi_io.xor_bytes(bf.decipher_block(block), previous_block))
+            previous_block = block
+
+
+class TestNumPyBlowfish(TestChiIOBase):
+    ## NumPy backend, only used when PyCrypto is not available, e.g. `env NO_PYCRYPTO=true`
+    def setUp(self):
+        if not chi_io.implementation.startswith('using NumPy'):
+            self.skip('NumPy backend not in use')
+
+    def test_ecb_matches_pyblowfish(self):
+        test_password = b'mypassword'
+        test_data = b"this is just a small piece of text, 48 bytes...." * 50
+
+        cipher = chi_io.CHI_cipher(test_password)
+        bf = pyblowfish.Blowfish(chi_io.md5checksum(test_password).digest())
+        crypted_data = bf.encrypt_ecb(test_data)
+        self.assertEqual(crypted_data, cipher.encrypt(test_data))
+        self.assertEqual(test_data, cipher.decrypt(crypted_data))
+        self.assertEqual(b'', cipher.decrypt(b''))
+
+
 class TestChiIO(TestChiIOBase):
     def test_get_what_you_put_in(self):
         test_data = b"this is just a small piece of text."
@@ -178,6 +290,94 @@ class TestChiIO(TestChiIOBase):
         # print repr(result_data)
         self.assertEqual(test_data, result_data)
 
+    def test_filewrite_spool(self):
+        test_data = b"this is just a small piece of text." * 100
+        test_password = b'mypassword'
+
+        fileptr1 = FakeFile()
+        chi_fileptr = chi_io.ChiAsFile(fileptr1, test_password, 'w', spool_size=1000)
+        for x in range(0, len(test_data), 70):
+            chi_fileptr.write(test_data[x:x + 70])
+        self.assertTrue(chi_fileptr._bufferedfileptr._rolled)  # spilled to disk
+        chi_fileptr.close()
+        result_data = chi_io.read_encrypted_file(FakeFile(fileptr1.getvalue()), test_password)
+        self.assertEqual(test_data, result_data)
+
+        fileptr1.seek(0)
+        chi_fileptr = chi_io.ChiAsFile(fileptr1, test_password, '+', spool_size=1000)
+        chi_fileptr.write(b'text')
+        chi_fileptr.close()
+        result_data = chi_io.read_encrypted_file(FakeFile(fileptr1.getvalue()), test_password)
+        self.assertEqual(b'text' + test_data[4:], result_data)
+
+    def test_filewrite_write_behind(self):
+        test_data = b"this is just a small piece of text."
+        test_password = b'mypassword'
+
+        fileptr1 = FakeFile()
+        chi_fileptr = chi_io.ChiAsFile(fileptr1, test_password, 'w', write_behind=True)
+        chi_fileptr.write(test_data)
+        pending = chi_fileptr.close()
+        self.assertRaises(ValueError, chi_fileptr.write, test_data)
+        pending.result(timeout=10)
+        self.assertTrue(pending.done())
+        self.assertEqual(None, pending.exception())
+        result_data = chi_io.read_encrypted_file(FakeFile(fileptr1.getvalue()), test_password)
+        self.assertEqual(test_data, result_data)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'test.chi')
+            chi_fileptr = chi_io.ChiAsFile(filename, test_password, 'w', write_behind=True)
+            chi_fileptr.write(test_data)
+            chi_fileptr.close()
+            chi_io.flush_write_behind()
+            self.assertEqual(test_data, chi_io.read_encrypted_file(filename, test_password))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_filewrite_not_closed(self):
+        # garbage collection does not encrypt/write, only close() does
+        fileptr1 = FakeFile()
+        chi_fileptr = chi_io.ChiAsFile(fileptr1, b'mypassword', 'w')
+        chi_fileptr.write(b"this is just a small piece of text.")
+        del chi_fileptr
+        gc.collect()
+        self.assertEqual(b'', fileptr1.getvalue())
+
+    def test_getvalue_deprecated(self):
+        test_data = b"this is just a small piece of text."
+        test_password = b'mypassword'
+        fileptr1 = FakeFile()
+        chi_fileptr = chi_io.ChiAsFile(fileptr1, test_password, 'w')
+        chi_fileptr.write(test_data)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(test_data, chi_fileptr.getvalue())
+            chi_fileptr.close()
+            chi_fileptr = chi_io.ChiAsFile(FakeFile(fileptr1.getvalue()), test_password)
+            chi_fileptr.seek(5)
+            self.assertEqual(test_data, chi_fileptr.getvalue())
+            self.assertEqual(5, chi_fileptr.tell())
+        self.assertEqual([DeprecationWarning, DeprecationWarning], [x.category for x in caught])
+
+    def test_gen_random_string_deprecated(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            result = chi_io.gen_random_string(8)
+        self.assertEqual(8, len(result))
+        self.assertTrue(isinstance(result, bytes))
+        self.assertEqual([DeprecationWarning], [x.category for x in caught])
+
+    def test_filewrite_write_behind_error(self):
+        fileptr1 = FakeFile()
+        fileptr1.close()  # writes will fail
+        chi_fileptr = chi_io.ChiAsFile(fileptr1, b'mypassword', 'w', write_behind=True)
+        chi_fileptr.write(b"this is just a small piece of text.")
+        pending = chi_fileptr.close()
+        self.assertRaises(ValueError, pending.result, 10)
+        self.assertTrue(isinstance(pending.exception(), ValueError))
+
     def test_file_bad_read(self):
         test_data = b"this is just a small piece of text."
         test_password = b'mypassword'
@@ -421,6 +621,100 @@ class TestCompatChiIO(TestCompatChiData):
         result_data = chi_fileptr.read()
         self.assertEqual(expected_plain_text_data, result_data)
 
+    def test_random_access_read(self):
+        plain_text_data = self.plain_text_data
+        chi_fileptr = chi_io.ChiAsFile(FakeFile(self.binary_data), self.password)
+        chi_fileptr.read_chunk_size = 64  # exercise cache and multi-chunk reads
+        chi_fileptr.read_cache_entries = 3
+        for offset, size in ((30, 10), (0, 1), (1000, 500), (63, 2), (1509, 100), (5, 300), (100, None), (2000, 10)):
+            chi_fileptr.seek(offset)
+            self.assertEqual(plain_text_data[offset:offset + size if size else None], chi_fileptr.read(size))
+            self.assertEqual(max(offset, min(len(plain_text_data), offset + (size or len(plain_text_data)))), chi_fileptr.tell())
+        self.assertTrue(len(chi_fileptr._chunks) <= 3)
+
+        self.assertEqual(len(plain_text_data) - 10, chi_fileptr.seek(-10, 2))
+        self.assertEqual(plain_text_data[-10:-5], chi_fileptr.read(5))
+        chi_fileptr.seek(-15, 1)
+        self.assertEqual(plain_text_data[-20:-10], chi_fileptr.read(10))
+        self.assertRaises(ValueError, chi_fileptr.seek, -1)
+        self.assertTrue(chi_fileptr.verify())
+        chi_fileptr.close()
+
+    def test_readline_iteration(self):
+        expected_lines = self.plain_text_data.splitlines(True)
+        for chunk_size in (8, 13 * 8, 4096):
+            chi_fileptr = chi_io.ChiAsFile(FakeFile(self.binary_data), self.password)
+            chi_fileptr.read_chunk_size = chunk_size
+            self.assertEqual(expected_lines, list(chi_fileptr))
+            self.assertTrue(chi_fileptr._verified)  # sequential read checked md5
+            chi_fileptr.close()
+
+        chi_fileptr = chi_io.ChiAsFile(FakeFile(self.binary_data), self.password)
+        self.assertEqual(b'aes', chi_fileptr.readline(3))
+        self.assertEqual(b'op\r\n', chi_fileptr.readline())
+        buf = bytearray(5)
+        self.assertEqual(5, chi_fileptr.readinto(buf))
+        self.assertEqual(self.plain_text_data[7:12], bytes(buf))
+
+    def test_io_wrappers(self):
+        expected_lines = self.plain_text_data.decode('us-ascii').splitlines(True)
+        with io.TextIOWrapper(chi_io.ChiAsFile(FakeFile(self.binary_data), self.password), encoding='us-ascii', newline='') as f:
+            self.assertEqual(expected_lines, list(f))
+        with io.BufferedReader(chi_io.ChiAsFile(FakeFile(self.binary_data), self.password), buffer_size=64) as f:
+            self.assertEqual(self.plain_text_data[:100], f.read(100))
+            f.seek(-10, 2)
+            self.assertEqual(self.plain_text_data[-10:], f.read())
+        self.assertTrue(f.closed)
+
+        chi_fileptr = chi_io.ChiAsFile(FakeFile(self.binary_data), b'badpassword')
+        self.assertRaises(chi_io.BadPassword, list, io.TextIOWrapper(chi_fileptr, encoding='latin1'))
+
+    def test_lazy_open(self):
+        chi_fileptr = chi_io.ChiAsFile(FakeFile(b'JUNKDATEHEREAS'), self.password)  # no error until used
+        self.assertRaises(chi_io.UnsupportedFile, chi_fileptr.read)
+        chi_fileptr = chi_io.ChiAsFile(FakeFile(self.binary_data[:-8]), self.password)
+        self.assertRaises(chi_io.UnsupportedFile, chi_fileptr.read)
+
+    def test_lazy_open_filename_unsupported(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'test.chi')
+            f = open(filename, 'wb')
+            f.write(self.binary_data[:-8])  # truncated
+            f.close()
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                chi_fileptr = chi_io.ChiAsFile(filename, self.password)
+                self.assertRaises(chi_io.UnsupportedFile, chi_fileptr.read)
+                f = open(filename, 'wb')
+                f.write(self.binary_data)  # fixed, retry reads from the start
+                f.close()
+                self.assertEqual(self.plain_text_data, chi_fileptr.read())
+                chi_fileptr.close()
+
+                chi_fileptr = chi_io.ChiAsFile(filename, self.password)
+                f = open(filename, 'wb')
+                f.write(b'JUNKDATEHEREAS')
+                f.close()
+                self.assertRaises(chi_io.UnsupportedFile, chi_fileptr.read)
+                chi_fileptr.close()
+                del chi_fileptr
+                gc.collect()
+            self.assertEqual([], [w for w in caught if w.category.__name__ == 'ResourceWarning'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_badpassword_verify(self):
+        chi_fileptr = chi_io.ChiAsFile(FakeFile(self.binary_data), b'badpassword')
+        chi_fileptr.seek(10)
+        chi_fileptr.read(10)  # unverified, garbage
+        self.assertRaises(chi_io.BadPassword, chi_fileptr.verify)
+
+        chi_fileptr = chi_io.ChiAsFile(FakeFile(self.binary_data), b'badpassword', verify=True)
+        chi_fileptr.seek(10)
+        chi_fileptr.read(10)
+        self.assertRaises(chi_io.BadPassword, chi_fileptr.close)
+
     def test_badpassword(self):
         test_password = b'badpassword'
 
@@ -452,6 +746,41 @@ class TestCompatChiDecrypt(TestCompatChiData):
         result_data = cipher.decrypt(self.binary_data)
         self.assertEqual(self.plain_text_data, result_data)
 
+    def test_cbc_decrypt_matches_per_block(self):
+        cipher = chi_io.CHI_cipher(self.password)
+        enc_data = self.binary_data[8:]
+
+        expected = []
+        previous_block = chi_io.CBC_IV
+        for offset in range(0, len(enc_data), 8):
+            block = enc_data[offset:offset + 8]
+            expected.append(chi_io.xor_bytes(cipher.decrypt(block), previous_block))
+            previous_block = block
+        expected = b''.join(expected)
+
+        self.assertEqual(expected, chi_io.cbc_decrypt(cipher, enc_data))
+        self.assertEqual(b'', chi_io.cbc_decrypt(cipher, b''))
+
+    def test_cbc_into_matches_per_block(self):
+        # either side of backend thresholds for hand chained (ECB) versus native CBC, see PyCryptoBlowfish
+        cipher = chi_io.CHI_cipher(self.password)
+        for block_count in (0, 1, 3, 8, 9, 16, 2049):
+            data = (self.plain_text_data * 12)[:block_count * 8]
+            expected = []
+            previous_block = chi_io.CBC_IV
+            for offset in range(0, len(data), 8):
+                previous_block = cipher.encrypt(chi_io.xor_bytes(data[offset:offset + 8], previous_block))
+                expected.append(previous_block)
+            expected = b''.join(expected)
+
+            self.assertEqual(expected, cipher.encrypt_cbc(data, chi_io.CBC_IV))
+            out = bytearray(len(data))
+            cipher.encrypt_cbc_into(data, chi_io.CBC_IV, memoryview(out))
+            self.assertEqual(expected, bytes(out))
+            out = bytearray(len(data))
+            cipher.decrypt_cbc_into(expected, chi_io.CBC_IV, memoryview(out))
+            self.assertEqual(data, bytes(out))
+
     def test_in_memory_decrypt_badpassword(self):
         test_password = b'badpassword'
 
@@ -537,6 +866,651 @@ class TestCompatChiDecrypt(TestCompatChiData):
         )
 
 
+class TestCompatChiStreamDecrypt(TestCompatChiData):
+    def test_iter_decrypt(self):
+        for chunk_size in (1, 7, 8, 13, 4096):
+            fileptr = FakeFile(self.binary_data)
+            result_data = b''.join(chi_io.iter_decrypt(fileptr, self.password, chunk_size=chunk_size))
+            self.assertEqual(self.plain_text_data, result_data)
+
+    def test_iter_decrypt_badpassword(self):
+        fileptr = FakeFile(self.binary_data)
+        result = chi_io.iter_decrypt(fileptr, b'badpassword', chunk_size=64)
+        next(result)  # unverified plaintext is available before the md5 check
+        self.assertRaises(chi_io.BadPassword, list, result)
+
+    def test_iter_decrypt_badinput(self):
+        for test_data in (b'', b'JUNKDATEHEREAS', b'BF01JUNKDATEHEREAS', self.binary_data + b'BF01JUNKDATEHEREAS'):
+            fileptr = FakeFile(test_data)
+            self.assertRaises(chi_io.UnsupportedFile, list, chi_io.iter_decrypt(fileptr, self.password))
+
+    def test_decoder(self):
+        decoder = chi_io.ChiDecoder(self.password)
+        result = []
+        for offset in range(0, len(self.binary_data), 100):
+            result.append(decoder.feed(self.binary_data[offset:offset + 100]))
+        result.append(decoder.finish())
+        self.assertEqual(self.plain_text_data, b''.join(result))
+        self.assertEqual(len(self.plain_text_data), decoder.plain_text_len)
+        self.assertRaises(ValueError, decoder.feed, b'more')
+
+
+class TestCompatChiReadHead(TestCompatChiData):
+    def test_read_head(self):
+        for nbytes in (0, 1, 7, 8, 9, 200, len(self.plain_text_data) - 1):
+            result_data, verified = chi_io.read_head(FakeFile(self.binary_data), self.password, nbytes)
+            self.assertEqual(self.plain_text_data[:nbytes], result_data)
+            self.assertFalse(verified)
+
+        for nbytes in (len(self.plain_text_data), len(self.plain_text_data) + 100):
+            for fileinfo in (FakeFile(self.binary_data), bytearray(self.binary_data), memoryview(self.binary_data)):
+                result_data, verified = chi_io.read_head(fileinfo, self.password, nbytes)
+                self.assertEqual(self.plain_text_data, result_data)
+                self.assertTrue(verified)
+
+    def test_read_head_reads_only_head(self):
+        fileptr = FakeFile(self.binary_data)
+        chi_io.read_head(fileptr, self.password, 20)
+        self.assertEqual(8 + 24 + 24, fileptr.tell())
+
+    def test_read_head_badpassword(self):
+        result_data, verified = chi_io.read_head(bytearray(self.binary_data), b'badpassword', 20)
+        self.assertNotEqual(self.plain_text_data[:20], result_data)
+        self.assertFalse(verified)
+        self.assertRaises(chi_io.BadPassword, chi_io.read_head, bytearray(self.binary_data), b'badpassword', len(self.plain_text_data))
+
+    def test_read_head_badinput(self):
+        self.assertRaises(chi_io.UnsupportedFile, chi_io.read_head, FakeFile(b'JUNKDATEHEREAS'), self.password)
+        self.assertRaises(chi_io.UnsupportedFile, chi_io.read_head, FakeFile(self.binary_data[:40]), self.password, 100)
+
+    def test_read_title(self):
+        self.assertEqual(b'aesop', chi_io.read_title(FakeFile(self.binary_data), self.password))
+        self.assertEqual(b'aes', chi_io.read_title(bytearray(self.binary_data), self.password, 3))
+
+
+class TestCompatChiFingerprint(TestCompatChiData):
+    def test_read_fingerprint(self):
+        expected = (len(self.plain_text_data), chi_io.md5checksum(self.plain_text_data).digest())
+        for fileinfo in (FakeFile(self.binary_data), bytearray(self.binary_data)):
+            self.assertEqual(expected, chi_io.read_fingerprint(fileinfo, self.password))
+        fileptr = FakeFile(self.binary_data)
+        chi_io.read_fingerprint(fileptr, self.password)
+        self.assertEqual(32, fileptr.tell())  # only header and 3 blocks read
+
+        # different salt, same fingerprint
+        crypted_data = chi_io.PEP272LikeCipher(self.password).encrypt(self.plain_text_data)
+        self.assertNotEqual(self.binary_data, crypted_data)
+        self.assertEqual(expected, chi_io.read_fingerprint(bytearray(crypted_data), self.password))
+
+    def test_read_fingerprint_badinput(self):
+        self.assertRaises(chi_io.UnsupportedFile, chi_io.read_fingerprint, FakeFile(b'JUNKDATEHEREAS'), self.password)
+        self.assertRaises(chi_io.UnsupportedFile, chi_io.read_fingerprint, FakeFile(self.binary_data[:24]), self.password)
+
+    def test_fingerprint_tree(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for filename, data in (('a.chi', self.binary_data), ('b.chs', self.binary_data), ('junk.chi', b'JUNK')):
+                f = open(os.path.join(tmp_dir, filename), 'wb')
+                f.write(data)
+                f.close()
+            result = list(chi_io.fingerprint_tree(tmp_dir, self.password))
+        finally:
+            shutil.rmtree(tmp_dir)
+        expected = (len(self.plain_text_data), chi_io.md5checksum(self.plain_text_data).digest())
+        self.assertEqual([expected, expected, None], [x[1] for x in result])
+        self.assertEqual(['a.chi', 'b.chs', 'junk.chi'], [os.path.basename(x[0]) for x in result])
+        self.assertTrue(isinstance(result[2][2], chi_io.UnsupportedFile))
+
+    def test_write_skip_unchanged(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'test.chi')
+            self.assertTrue(chi_io.write_encrypted_file(filename, self.password, self.plain_text_data, skip_unchanged=True))  # does not exist yet
+            with open(filename, 'rb') as f:
+                original = f.read()
+            self.assertFalse(chi_io.write_encrypted_file(filename, self.password, self.plain_text_data, skip_unchanged=True))
+            self.assertFalse(chi_io.write_encrypted_file(filename, self.password, self.plain_text_data, use_mmap=True, skip_unchanged=True))
+            with open(filename, 'rb') as f:
+                self.assertEqual(original, f.read())  # untouched, salt is random so any rewrite differs
+            self.assertTrue(chi_io.write_encrypted_file(filename, b'other', self.plain_text_data, skip_unchanged=True))
+            self.assertTrue(chi_io.write_encrypted_file(filename, b'other', self.plain_text_data + b'x', skip_unchanged=True))
+            self.assertTrue(chi_io.write_encrypted_file(filename, b'other', self.plain_text_data + b'x'))  # default always writes
+            self.assertEqual(self.plain_text_data + b'x', chi_io.read_encrypted_file(filename, b'other'))
+
+            chi_fileptr = chi_io.ChiAsFile(filename, b'other', 'w', skip_unchanged=True)
+            chi_fileptr.write(self.plain_text_data + b'x')
+            self.assertFalse(chi_fileptr.close())
+            chi_fileptr = chi_io.ChiAsFile(filename, b'other', 'w', skip_unchanged=True, write_behind=True)
+            chi_fileptr.write(self.plain_text_data)
+            self.assertTrue(chi_fileptr.close().result(timeout=10))
+            self.assertEqual(self.plain_text_data, chi_io.read_encrypted_file(filename, b'other'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_readwrite_skip_unchanged(self):
+        fileptr = FakeFile(self.binary_data)
+        chi_fileptr = chi_io.ChiAsFile(fileptr, self.password, '+', skip_unchanged=True)
+        self.assertFalse(chi_fileptr.close())  # nothing written
+        self.assertEqual(self.binary_data, fileptr.getvalue())
+
+        fileptr.seek(0)
+        chi_fileptr = chi_io.ChiAsFile(fileptr, self.password, '+', skip_unchanged=True)
+        chi_fileptr.write(self.plain_text_data[:4])  # same content
+        self.assertFalse(chi_fileptr.close())
+        self.assertEqual(self.binary_data, fileptr.getvalue())
+
+        fileptr.seek(0)
+        chi_fileptr = chi_io.ChiAsFile(fileptr, self.password, '+', skip_unchanged=True)
+        chi_fileptr.write(b'XXXX')
+        self.assertTrue(chi_fileptr.close())
+        self.assertEqual(b'XXXX' + self.plain_text_data[4:], chi_io.read_encrypted_file(FakeFile(fileptr.getvalue()), self.password))
+
+
+class TestPlainTextCache(TestCompatChiData):
+    def test_lru_eviction(self):
+        cache = chi_io.PlainTextCache(max_bytes=10)
+        cache.put('a', b'aaaa')
+        cache.put('b', b'bbbb')
+        self.assertEqual(b'aaaa', cache.get('a'))  # b is now least recently used
+        cache.put('c', b'cccc')
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(b'aaaa', cache.get('a'))
+        cache.put('big', b'x' * 11)  # larger than the budget, not cached
+        self.assertEqual(None, cache.get('big'))
+        self.assertEqual({'hits': 2, 'misses': 2, 'evictions': 1, 'invalidations': 0, 'entries': 2, 'bytes': 8}, cache.stats())
+        self.assertEqual(None, cache.get('a', identity='changed'))
+        self.assertEqual(1, cache.stats()['invalidations'])
+        self.assertEqual(4, cache.stats()['bytes'])
+
+    def test_disabled(self):
+        cache = chi_io.PlainTextCache(max_bytes=0)
+        cache.put('a', b'aaaa')
+        self.assertEqual(None, cache.get('a'))
+
+    def test_read_filename(self):
+        cache = chi_io.PlainTextCache()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'test.chi')
+            with open(filename, 'wb') as f:
+                f.write(self.binary_data)
+            for x in range(3):
+                self.assertEqual(self.plain_text_data, chi_io.read_encrypted_file(filename, self.password, cache=cache))
+            self.assertEqual(2, cache.stats()['hits'])
+            self.assertRaises(chi_io.BadPassword, chi_io.read_encrypted_file, filename, b'bad', cache=cache)
+
+            chi_io.write_encrypted_file(filename, self.password, b'new text')
+            os.utime(filename, (0, 0))  # ensure mtime differs
+            self.assertEqual(b'new text', chi_io.read_encrypted_file(filename, self.password, cache=cache))
+            self.assertEqual(1, cache.stats()['invalidations'])
+            cache.invalidate(filename)
+            self.assertEqual(0, cache.stats()['entries'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_fileobject(self):
+        cache = chi_io.PlainTextCache()
+        for fileinfo in (FakeFile(self.binary_data), bytearray(self.binary_data)):
+            for x in range(2):
+                if not isinstance(fileinfo, bytearray):
+                    fileinfo.seek(0)
+                self.assertEqual(self.plain_text_data, chi_io.read_encrypted_file(fileinfo, self.password, cache=cache))
+                if not isinstance(fileinfo, bytearray):
+                    self.assertEqual(len(self.binary_data), fileinfo.tell())
+        self.assertEqual(3, cache.stats()['hits'])  # file object and bytearray share the same key
+        self.assertRaises(chi_io.BadPassword, chi_io.read_encrypted_file, bytearray(self.binary_data), b'bad', cache=cache)
+        self.assertRaises(chi_io.ChiIO, chi_io.read_encrypted_file, bytearray(self.binary_data[:-8]), self.password, cache=cache)  # not a hit
+
+        # same header and length, different ciphertext (e.g. an edited copy) is not a hit
+        edited_data = bytearray(self.binary_data)
+        edited_data[-20] ^= 1
+        self.assertRaises(chi_io.BadPassword, chi_io.read_encrypted_file, edited_data, self.password, cache=cache)
+        other_data = bytearray(chi_io.PEP272LikeCipher(self.password).encrypt(self.plain_text_data[:-1] + b'!'))
+        other_data[:8 + 24] = self.binary_data[:8 + 24]  # header (salt and md5) from the cached note
+        self.assertRaises(chi_io.BadPassword, chi_io.read_encrypted_file, FakeFile(bytes(other_data)), self.password, cache=cache)
+
+    def test_read_fileobject_no_sha256(self):
+        cache = chi_io.PlainTextCache()
+        orig_sha256checksum = chi_io.sha256checksum
+        chi_io.sha256checksum = None  # as pre hashlib Python
+        try:
+            for x in range(2):
+                self.assertEqual(self.plain_text_data, chi_io.read_encrypted_file(bytearray(self.binary_data), self.password, cache=cache))
+        finally:
+            chi_io.sha256checksum = orig_sha256checksum
+        self.assertEqual(0, cache.stats()['entries'])  # not cached, rather than keyed on a weaker hash
+
+    def test_threads(self):
+        cache = chi_io.PlainTextCache(max_bytes=len(self.plain_text_data) * 3)
+        crypted_data = [bytearray(chi_io.PEP272LikeCipher(self.password).encrypt(self.plain_text_data + str(x).encode('ascii'))) for x in range(5)]
+        errors = []
+
+        def reader():
+            try:
+                for x in range(50):
+                    n = x % 5
+                    self.assertEqual(self.plain_text_data + str(n).encode('ascii'), chi_io.read_encrypted_file(crypted_data[n], self.password, cache=cache))
+            except Exception as info:
+                errors.append(info)
+
+        threads = [threading.Thread(target=reader) for x in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        stats = cache.stats()
+        self.assertEqual(200, stats['hits'] + stats['misses'])
+        self.assertTrue(stats['bytes'] <= cache.max_bytes)
+
+
+class TestKeyring(TestCompatChiData):
+    def test_tail_padding(self):
+        enc_len, enc_data = chi_io.read_header(self.binary_data)  # Tombo padding
+        self.assertTrue(chi_io._tail_padding_ok(chi_io.CHI_cipher(self.password), enc_data, enc_len))
+        self.assertFalse(chi_io._tail_padding_ok(chi_io.CHI_cipher(b'bad'), enc_data, enc_len))
+        for plain_text in (b'1', b'1234567', b'12345678'):  # chi_io padding, and none
+            enc_len, enc_data = chi_io.read_header(chi_io.PEP272LikeCipher(self.password).encrypt(plain_text))
+            self.assertTrue(chi_io._tail_padding_ok(chi_io.CHI_cipher(self.password), enc_data, enc_len))
+
+    def test_read(self):
+        keyring = chi_io.Keyring([b'one', b'two'])
+        self.assertRaises(chi_io.BadPassword, chi_io.read_encrypted_file, FakeFile(self.binary_data), keyring)
+        self.assertRaises(chi_io.UnsupportedFile, chi_io.read_encrypted_file, FakeFile(b'JUNK'), keyring)
+        keyring.add(self.password)
+        keyring.add(b'one')  # already present
+        self.assertEqual(3, len(keyring))
+        for fileinfo in (FakeFile(self.binary_data), bytearray(self.binary_data)):
+            self.assertEqual(self.plain_text_data, chi_io.read_encrypted_file(fileinfo, keyring))
+        self.assertTrue(keyring.ciphers()[0] is chi_io.CHI_cipher(self.password))  # most recently successful first
+
+    def test_read_tree(self):
+        keyring = chi_io.Keyring([b'one', b'two', b'three'])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for dirname, password in (('a', b'one'), ('b', b'two'), ('c', b'three')):
+                os.mkdir(os.path.join(tmp_dir, dirname))
+                for x in range(3):
+                    chi_io.write_encrypted_file(os.path.join(tmp_dir, dirname, '%d.chi' % x), password, dirname.encode('ascii') * 8)
+            for dirname, password in (('a', b'one'), ('b', b'two'), ('c', b'three')):
+                filename = os.path.join(tmp_dir, dirname, '0.chi')
+                for use_mmap in (False, True):
+                    self.assertEqual(dirname.encode('ascii') * 8, keyring.read(filename, use_mmap=use_mmap))
+                self.assertTrue(keyring.ciphers()[0] is chi_io.CHI_cipher(password))
+            # key that last opened a file in the directory is tried first
+            self.assertTrue(keyring.ciphers(os.path.join(tmp_dir, 'a', '1.chi'))[0] is chi_io.CHI_cipher(b'one'))
+            self.assertTrue(keyring.ciphers(os.path.join(tmp_dir, 'b', '0.chi'))[0] is chi_io.CHI_cipher(b'two'))
+            self.assertTrue(keyring.ciphers(os.path.join(tmp_dir, 'other.chi'))[0] is chi_io.CHI_cipher(b'three'))
+            self.assertEqual(3, len(keyring._last_used))  # one entry per directory, not per file
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_no_match(self):
+        keyring = chi_io.Keyring([b'one', b'two'])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'test.chi')
+            with open(filename, 'wb') as f:
+                f.write(self.binary_data)
+            for use_mmap in (False, True):
+                self.assertRaises(chi_io.BadPassword, keyring.read, filename, use_mmap=use_mmap)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class TestChiStreamEncrypt(TestCompatChiData):
+    def test_encrypt_stream(self):
+        for chunk_size in (1, 7, 8, 13, 4096):
+            src = FakeFile(self.plain_text_data)
+            dst = FakeFile()
+            chi_io.encrypt_stream(src, dst, self.password, chunk_size=chunk_size)
+            crypted_data = dst.getvalue()
+            self.assertEqual(chi_io.encrypted_size(len(self.plain_text_data)), len(crypted_data))
+            result_data = chi_io.PEP272LikeCipher(self.password).decrypt(crypted_data)
+            self.assertEqual(self.plain_text_data, result_data)
+
+    def test_encrypt_stream_known_md5(self):
+        plain_text_md5sum = chi_io.md5checksum(self.plain_text_data).digest()
+
+        src = FakeFile(self.plain_text_data)
+        dst = FakeFile()
+        chi_io.encrypt_stream(src, dst, self.password, plain_text_md5sum=plain_text_md5sum)
+        result_data = chi_io.PEP272LikeCipher(self.password).decrypt(dst.getvalue())
+        self.assertEqual(self.plain_text_data, result_data)
+
+        src = FakeFile(self.plain_text_data)
+        src.seek = None  # not seekable
+        dst = FakeFile()
+        chi_io.encrypt_stream(src, dst, self.password, plain_text_md5sum=plain_text_md5sum, plain_text_len=len(self.plain_text_data))
+        result_data = chi_io.PEP272LikeCipher(self.password).decrypt(dst.getvalue())
+        self.assertEqual(self.plain_text_data, result_data)
+
+        src = FakeFile(self.plain_text_data)
+        self.assertRaises(
+            chi_io.ChiIO,
+            chi_io.encrypt_stream,
+            src, FakeFile(), self.password, plain_text_md5sum=b'0123456789ABCDEF'
+        )
+
+    def test_encoder_matches_encrypt_into_buffer(self):
+        cipher = chi_io.CHI_cipher(self.password)
+        for test_data in (b'', b'1234567', b'12345678', self.plain_text_data):
+            plain_text_md5sum = chi_io.md5checksum(test_data).digest()
+            encoder = chi_io.ChiEncoder(cipher, plain_text_md5sum, len(test_data), salt=b'12345678')
+            crypted_data = encoder.feed(test_data[:5]) + encoder.feed(test_data[5:]) + encoder.finish()
+
+            out = bytearray(chi_io.encrypted_size(len(test_data)))
+            chi_io.encrypt_into_buffer(cipher, test_data, out, salt=b'12345678')
+            self.assertEqual(bytes(out), crypted_data)
+
+
+class TestChiMmap(TestCompatChiData):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.chi')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_buffers(self):
+        for buffer_type in (bytearray, memoryview):
+            result_data = chi_io.read_encrypted_file(buffer_type(self.binary_data), self.password)
+            self.assertEqual(self.plain_text_data, result_data)
+
+    def test_read_mmap(self):
+        f = open(self.filename, 'wb')
+        f.write(self.binary_data)
+        f.close()
+        result_data = chi_io.read_encrypted_file(self.filename, self.password, use_mmap=True)
+        self.assertEqual(self.plain_text_data, result_data)
+
+        f = open(self.filename, 'rb')
+        mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            result_data = chi_io.read_encrypted_file(mapped_file, self.password)
+        finally:
+            mapped_file.close()
+            f.close()
+        self.assertEqual(self.plain_text_data, result_data)
+
+    def test_read_mmap_empty(self):
+        open(self.filename, 'wb').close()
+        self.assertRaises(chi_io.UnsupportedFile, chi_io.read_encrypted_file, self.filename, self.password, use_mmap=True)
+
+    def test_read_mmap_badpassword(self):
+        f = open(self.filename, 'wb')
+        f.write(self.binary_data)
+        f.close()
+        self.assertRaises(chi_io.BadPassword, chi_io.read_encrypted_file, self.filename, b'bad', use_mmap=True)
+
+    def test_read_mmap_extra_bytes(self):
+        f = open(self.filename, 'wb')
+        f.write(self.binary_data + b'xyz')
+        f.close()
+        self.assertRaises(chi_io.UnsupportedFile, chi_io.read_encrypted_file, self.filename, self.password, use_mmap=True)
+
+    def test_write_mmap(self):
+        for test_data in (b'', b'1234567', self.plain_text_data):
+            chi_io.write_encrypted_file(self.filename, self.password, test_data, use_mmap=True)
+            self.assertEqual(chi_io.encrypted_size(len(test_data)), os.path.getsize(self.filename))
+            result_data = chi_io.read_encrypted_file(self.filename, self.password)
+            self.assertEqual(test_data, result_data)
+
+
+class TestChiStat(TestCompatChiData):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'subdir'))
+        self.write_file('good.chi', self.binary_data)
+        self.write_file('truncated.chi', self.binary_data[:-8])
+        self.write_file(os.path.join('subdir', 'extra.CHS'), self.binary_data + b'12345678')
+        self.write_file(os.path.join('subdir', 'junk.chi'), b'JUNK')
+        self.write_file('ignored.txt', self.binary_data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, filename, data):
+        f = open(os.path.join(self.tmp_dir, filename), 'wb')
+        f.write(data)
+        f.close()
+
+    def test_chi_stat(self):
+        filename = os.path.join(self.tmp_dir, 'good.chi')
+        result = chi_io.chi_stat(filename)
+        self.assertEqual(chi_io.ChiStat(filename, True, len(self.plain_text_data), len(self.binary_data), len(self.binary_data), chi_io.STAT_OK), result)
+
+        result = chi_io.chi_stat(os.path.join(self.tmp_dir, 'truncated.chi'))
+        self.assertEqual(chi_io.STAT_TRUNCATED, result.status)
+        self.assertEqual(len(self.plain_text_data), result.plain_text_len)
+
+        result = chi_io.chi_stat(os.path.join(self.tmp_dir, 'subdir', 'junk.chi'))
+        self.assertEqual((False, None, 4, chi_io.STAT_NOT_CHI), (result.is_chi, result.plain_text_len, result.file_size, result.status))
+
+    def test_scan_tree(self):
+        result = [(os.path.relpath(x.filename, self.tmp_dir), x.status) for x in chi_io.scan_tree(self.tmp_dir)]
+        self.assertEqual(
+            [
+                ('good.chi', chi_io.STAT_OK),
+                (os.path.join('subdir', 'extra.CHS'), chi_io.STAT_EXTRA_BYTES),
+                (os.path.join('subdir', 'junk.chi'), chi_io.STAT_NOT_CHI),
+                ('truncated.chi', chi_io.STAT_TRUNCATED),
+            ],
+            sorted(result)
+        )
+
+    def test_scan_tree_vanished(self):
+        # file removed (or unreadable) after the directory was listed
+        iter_tree_files = chi_io.iter_tree_files
+
+        def vanishing_iter_tree_files(root, extensions):
+            for filename, file_size in iter_tree_files(root, extensions):
+                if os.path.basename(filename) == 'good.chi':
+                    os.remove(filename)
+                yield filename, file_size
+
+        chi_io.iter_tree_files = vanishing_iter_tree_files
+        try:
+            result = dict((os.path.relpath(x.filename, self.tmp_dir), x) for x in chi_io.scan_tree(self.tmp_dir))
+        finally:
+            chi_io.iter_tree_files = iter_tree_files
+        self.assertEqual(4, len(result))
+        self.assertEqual(chi_io.STAT_ERROR, result['good.chi'].status)
+        self.assertTrue(isinstance(result['good.chi'].error, (IOError, OSError)))
+        self.assertEqual(chi_io.STAT_TRUNCATED, result['truncated.chi'].status)
+        self.assertEqual(None, result['truncated.chi'].error)
+
+    def test_unreadable_directory(self):
+        if not hasattr(os, 'getuid') or os.getuid() == 0:
+            self.skipTest('permissions are not enforced')  # e.g. Windows, root
+        subdir = os.path.join(self.tmp_dir, 'subdir')
+        os.chmod(subdir, 0)
+        try:
+            result = [os.path.relpath(x.filename, self.tmp_dir) for x in chi_io.scan_tree(self.tmp_dir)]
+        finally:
+            os.chmod(subdir, 0o755)
+        self.assertEqual(['good.chi', 'truncated.chi'], sorted(result))
+
+    def test_read_not_chi(self):
+        self.assertRaises(chi_io.UnsupportedFile, chi_io.read_encrypted_file, os.path.join(self.tmp_dir, 'subdir', 'junk.chi'), self.password)
+
+
+class TestDecryptTree(TestCompatChiData):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'subdir'))
+        self.expected = {}
+        for x in range(12):
+            filename = os.path.join(self.tmp_dir, 'subdir' if x % 2 else '', 'note%d.chi' % x)
+            plain_text = b'note %d ' % x + b'text' * (x * 50)
+            chi_io.write_encrypted_file(filename, self.password, plain_text)
+            self.expected[filename] = plain_text
+        self.bad_password_filename = os.path.join(self.tmp_dir, 'other_password.chs')
+        chi_io.write_encrypted_file(self.bad_password_filename, b'other', b'other')
+        self.junk_filename = os.path.join(self.tmp_dir, 'subdir', 'junk.chi')
+        f = open(self.junk_filename, 'wb')
+        f.write(b'JUNK')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_results(self, result):
+        self.assertTrue(isinstance(result.pop(self.bad_password_filename), chi_io.BadPassword))
+        self.assertTrue(isinstance(result.pop(self.junk_filename), chi_io.UnsupportedFile))
+        self.assertEqual(self.expected, result)
+
+    def test_decrypt_tree(self):
+        for jobs in (1, 2):
+            self.check_results(chi_io.decrypt_tree(self.tmp_dir, self.password, jobs=jobs))
+
+    def test_imap_decrypt_tree(self):
+        result = {}
+        for filename, plain_text, exception in chi_io.imap_decrypt_tree(self.tmp_dir, self.password, jobs=2):
+            self.assertTrue((plain_text is None) != (exception is None))
+            result[filename] = plain_text if exception is None else exception
+        self.check_results(result)
+
+    def test_batch_by_size(self):
+        files = [('big', 1000000), ('a', 10), ('b', 20), ('c', 30)]
+        self.assertEqual([['big'], ['c', 'b', 'a']], chi_io._batch_by_size(files, 2))
+
+    def test_rekey_file(self):
+        filename = self.bad_password_filename
+        os.chmod(filename, 0o640)
+        before = os.listdir(self.tmp_dir)
+        self.assertRaises(chi_io.BadPassword, chi_io.rekey_file, filename, self.password, b'new')
+        self.assertEqual(b'other', chi_io.read_encrypted_file(filename, b'other'))  # untouched
+        self.assertEqual(before, os.listdir(self.tmp_dir))  # temporary file removed
+        self.assertRaises(chi_io.UnsupportedFile, chi_io.rekey_file, self.junk_filename, self.password, b'new')
+
+        chi_io.rekey_file(filename, b'other', b'new', chunk_size=3)
+        self.assertEqual(b'other', chi_io.read_encrypted_file(filename, b'new'))
+        self.assertEqual(0o640, os.stat(filename).st_mode & 0o777)
+        self.assertEqual(sorted(before), sorted(os.listdir(self.tmp_dir)))
+
+    def test_rekey_tree(self):
+        for jobs, old_password, new_password in ((1, self.password, b'new'), (2, b'new', b'newer')):
+            result = chi_io.rekey_tree(self.tmp_dir, old_password, new_password, jobs=jobs)
+            self.assertTrue(isinstance(result.pop(self.bad_password_filename), chi_io.BadPassword))
+            self.assertTrue(isinstance(result.pop(self.junk_filename), chi_io.UnsupportedFile))
+            self.assertEqual(dict.fromkeys(self.expected), result)
+            self.check_results(chi_io.decrypt_tree(self.tmp_dir, new_password, jobs=1))
+        self.assertEqual(b'other', chi_io.read_encrypted_file(self.bad_password_filename, b'other'))
+
+
+class TestParallelDecrypt(TestCompatChiData):
+    def setUp(self):
+        if not chi_io.can_parallel_decrypt(2, chi_io.PARALLEL_DECRYPT_MIN_SIZE):
+            self.skip('multiprocessing.shared_memory and concurrent.futures required')
+        self.saved_sizes = chi_io.PARALLEL_DECRYPT_MIN_SIZE, chi_io.PARALLEL_DECRYPT_MIN_CHUNK
+        chi_io.PARALLEL_DECRYPT_MIN_SIZE, chi_io.PARALLEL_DECRYPT_MIN_CHUNK = 64, 8 * 20  # force lots of work items
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        chi_io.PARALLEL_DECRYPT_MIN_SIZE, chi_io.PARALLEL_DECRYPT_MIN_CHUNK = self.saved_sizes
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parallel_decrypt(self):
+        cipher = chi_io.PEP272LikeCipher(self.password)
+        self.assertEqual(self.plain_text_data, cipher.decrypt(self.binary_data, jobs=3))
+
+        filename = os.path.join(self.tmp_dir, 'test.chi')
+        f = open(filename, 'wb')
+        f.write(self.binary_data)
+        f.close()
+        self.assertEqual(self.plain_text_data, chi_io.read_encrypted_file(filename, self.password, jobs=3))
+
+    def test_parallel_decrypt_badpassword(self):
+        cipher = chi_io.PEP272LikeCipher(b'badpassword')
+        self.assertRaises(chi_io.BadPassword, cipher.decrypt, self.binary_data, jobs=2)
+        self.assertRaises(chi_io.UnsupportedFile, cipher.decrypt, self.binary_data + b'1234', jobs=2)
+
+
+class TestChiAsync(TestCompatChiData):
+    def setUp(self):
+        if chi_async is None:
+            self.skip('asyncio (async/await) not available')
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'test.chi')
+        f = open(self.filename, 'wb')
+        f.write(self.binary_data)
+        f.close()
+
+    def tearDown(self):
+        import asyncio
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_aread_encrypted_file(self):
+        for chunk_size in (64, 100, 1024 * 1024):
+            progress = []
+            result_data = self.loop.run_until_complete(chi_async.aread_encrypted_file(self.filename, self.password, chunk_size=chunk_size, progress=lambda done, total: progress.append((done, total))))
+            self.assertEqual(self.plain_text_data, result_data)
+            self.assertEqual((len(self.binary_data), len(self.binary_data)), progress[-1])
+
+    def test_aread_encrypted_file_badpassword(self):
+        for chunk_size in (64, 1024 * 1024):
+            self.assertRaises(chi_io.BadPassword, self.loop.run_until_complete, chi_async.aread_encrypted_file(self.filename, b'badpassword', chunk_size=chunk_size))
+
+    def test_awrite_encrypted_file(self):
+        progress = []
+        self.loop.run_until_complete(chi_async.awrite_encrypted_file(self.filename, self.password, self.plain_text_data, chunk_size=100, progress=lambda done, total: progress.append(done)))
+        self.assertEqual(len(self.plain_text_data), progress[-1])
+        self.assertEqual(self.plain_text_data, chi_io.read_encrypted_file(self.filename, self.password))
+
+    def test_concurrent_reads(self):
+        import asyncio
+        tasks = asyncio.gather(*[chi_async.aread_encrypted_file(self.filename, self.password, chunk_size=64) for x in range(20)])
+        self.assertEqual([self.plain_text_data] * 20, self.loop.run_until_complete(tasks))
+
+    def test_cancel(self):
+        import asyncio
+        progress = []
+
+        def cancel_on_progress(done, total):
+            progress.append(done)
+            task.cancel()
+
+        task = self.loop.create_task(chi_async.aread_encrypted_file(self.filename, self.password, chunk_size=64, progress=cancel_on_progress))
+        self.assertRaises(asyncio.CancelledError, self.loop.run_until_complete, task)
+        self.assertEqual([64], progress)
+
+    def test_cancel_waits_for_executor(self):
+        import asyncio
+        started = threading.Event()
+        release = threading.Event()
+        seen = []
+        orig_read_and_feed = chi_async._read_and_feed
+
+        def slow_read_and_feed(in_file, decoder, chunk_size):
+            seen.append(in_file)
+            started.set()
+            release.wait(5)
+            result = orig_read_and_feed(in_file, decoder, chunk_size)  # raises if in_file was closed under us
+            seen.append(in_file.closed)
+            return result
+
+        chi_async._read_and_feed = slow_read_and_feed
+        try:
+            task = self.loop.create_task(chi_async.aread_encrypted_file(self.filename, self.password, chunk_size=64))
+            self.loop.run_until_complete(self.loop.run_in_executor(None, started.wait, 5))
+            task.cancel()
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+            seen.append(seen[0].closed)  # still open, task waiting for executor
+            release.set()
+            self.assertRaises(asyncio.CancelledError, self.loop.run_until_complete, task)
+        finally:
+            chi_async._read_and_feed = orig_read_and_feed
+        self.assertEqual(False, seen[1])
+        self.assertEqual(False, seen[2])
+        self.assertTrue(seen[0].closed)
+
+
 class TestCompatChiEncryptDecrypt(TestCompatChiData):
     ## in memory equiv of TestChiIO.test_get_what_you_put_in()
     def test_get_what_you_put_in(self):
@@ -559,6 +1533,45 @@ class TestCompatChiEncryptDecrypt(TestCompatChiData):
         result_data = cipher.decrypt(crypted_data)
         self.assertEqual(test_data, result_data)
 
+    def test_encrypt_into_buffer_partial_block(self):
+        test_data = b"this is just a small piece of text."  # 24 + 35 bytes, 3 byte partial last block
+        test_password = b'mypassword'
+
+        cipher = chi_io.CHI_cipher(test_password)
+        out = bytearray(chi_io.encrypted_size(len(test_data)))
+        self.assertEqual(8 + 64, len(out))
+        out_len = chi_io.encrypt_into_buffer(cipher, test_data, out, salt=b'12345678')
+        self.assertEqual(len(out), out_len)
+
+        # Tombo only XORs the real bytes in the last block, padding repeats them
+        previous_block, last_block = bytes(out[-16:-8]), bytes(out[-8:])
+        tail = chi_io.xor_bytes(test_data[-3:], previous_block[:3])
+        self.assertEqual((tail * 3)[:8], cipher.decrypt(last_block))
+
+        result_data = chi_io.PEP272LikeCipher(test_password).decrypt(bytes(out))
+        self.assertEqual(test_data, result_data)
+
+    def test_decrypt_into_encrypt_into(self):
+        cipher = chi_io.PEP272LikeCipher(self.password)
+        out = bytearray(len(self.plain_text_data) + 10)  # reused
+        crypted_out = bytearray(chi_io.encrypted_size(len(self.plain_text_data)) + 3)
+        for test_data in (b'', b'1234567', b'12345678', b'123456789', self.plain_text_data):
+            crypted_len = cipher.encrypt_into(test_data, crypted_out)
+            self.assertEqual(chi_io.encrypted_size(len(test_data)), crypted_len)
+            crypted_data = bytes(crypted_out[:crypted_len])
+            self.assertEqual(test_data, cipher.decrypt(crypted_data))
+
+            result_len = cipher.decrypt_into(crypted_data, out)
+            self.assertEqual(len(test_data), result_len)
+            self.assertEqual(test_data, bytes(out[:result_len]))
+            result_len = cipher.decrypt_into(memoryview(crypted_out)[:crypted_len], memoryview(out)[3:])
+            self.assertEqual(test_data, bytes(out[3:3 + result_len]))
+
+        self.assertRaises(chi_io.ChiIO, cipher.decrypt_into, self.binary_data, bytearray(len(self.plain_text_data) - 1))
+        self.assertRaises(chi_io.ChiIO, cipher.encrypt_into, b'1234', bytearray(chi_io.encrypted_size(4) - 1))
+        self.assertRaises(chi_io.UnsupportedFile, cipher.decrypt_into, self.binary_data[:-8], out)
+        self.assertRaises(chi_io.BadPassword, chi_io.PEP272LikeCipher(b'badpassword').decrypt_into, self.binary_data, out)
+
     def test_same_input_different_crypted_text(self):
         test_data = b"this is just a small piece of text."
         test_password = b'mypassword'
@@ -574,6 +1587,44 @@ class TestCompatChiEncryptDecrypt(TestCompatChiData):
         result_data = cipher.decrypt(crypted_data2)
         self.assertEqual(test_data, result_data)
 
+    def test_encrypt_many(self):
+        test_password = b'mypassword'
+        # ragged lengths, every partial last block length, empty and larger notes
+        test_data = [b'x' * length for length in range(0, 17)] + [self.plain_text_data, b'', b'this is just a small piece of text.']
+
+        cipher = chi_io.PEP272LikeCipher(test_password)
+
+        crypted_data = cipher.encrypt_many(test_data)
+        self.assertEqual(len(test_data), len(crypted_data))
+        for plain_text, crypted_text in zip(test_data, crypted_data):
+            self.assertEqual(chi_io.encrypted_size(len(plain_text)), len(crypted_text))
+            self.assertEqual(plain_text, cipher.decrypt(crypted_text))
+
+        crypted_data = chi_io.encrypt_many(test_data[-3:], test_password)
+        self.assertEqual(test_data[-3:], [cipher.decrypt(x) for x in crypted_data])
+        self.assertEqual([], cipher.encrypt_many([]))
+
+    def test_encrypt_many_large_and_small(self):
+        # one large note (finished one note at a time) and two medium notes among many small ones
+        test_data = [self.plain_text_data * 20, b'medium note ' * 30, b'medium note2 ' * 30] + [b'small %d' % x * (x % 7 + 1) for x in range(300)]
+        cipher = chi_io.PEP272LikeCipher(b'mypassword')
+        crypted_data = cipher.encrypt_many(test_data)
+        for plain_text, crypted_text in zip(test_data, crypted_data):
+            self.assertEqual(chi_io.encrypted_size(len(plain_text)), len(crypted_text))
+            self.assertEqual(plain_text, cipher.decrypt(crypted_text))
+
+    def test_encrypt_many_unicode_strings_rejected(self):
+        test_data = [b"this is just a small piece of text.", u"this is just a small piece of text."]
+        test_password = b'mypassword'
+
+        cipher = chi_io.PEP272LikeCipher(test_password)
+
+        self.assertRaises(
+            chi_io.ChiIO,
+            cipher.encrypt_many,
+            test_data
+        )
+
     def test_unicode_strings_rejected(self):
         test_data = u"this is just a small piece of text."
         test_password = b'mypassword'
@@ -587,6 +1638,52 @@ class TestCompatChiEncryptDecrypt(TestCompatChiData):
         )
 
 
+class TestKeyState(TestCompatChiData):
+    def test_export_import(self):
+        key_state = chi_io.export_key_state(self.password)
+        self.assertTrue(key_state.startswith(chi_io.KEY_STATE_MAGIC))
+        self.assertTrue(len(key_state) in (8 + 16, 8 + 16 + chi_io.KEY_STATE_SIZE))
+
+        chi_io.clear_key_cache()  # force key state to be used
+        cipher = chi_io.CHI_cipher(key_state)
+        self.assertEqual(key_state, cipher.export_key_state())
+        result_data = chi_io.PEP272LikeCipher(cipher).decrypt(self.binary_data)
+        self.assertEqual(self.plain_text_data, result_data)
+
+        chi_io.clear_key_cache()
+        result_data = chi_io.read_encrypted_file(FakeFile(self.binary_data), key_state)
+        self.assertEqual(self.plain_text_data, result_data)
+
+    def test_import_does_not_poison_cache(self):
+        # key state claiming to be for self.password, with the expanded key of another password
+        md5key = chi_io.md5checksum(self.password).digest()
+        crafted_state = chi_io.KEY_STATE_MAGIC + md5key + pyblowfish.Blowfish(chi_io.md5checksum(b'other').digest()).export_key_state()
+        chi_io.clear_key_cache()
+        chi_io.CHI_cipher(crafted_state)
+        chi_io.CHI_cipher(crafted_state)  # cached (under the state)
+        result_data = chi_io.read_encrypted_file(FakeFile(self.binary_data), self.password)
+        self.assertEqual(self.plain_text_data, result_data)
+
+    def test_pickle(self):
+        import pickle
+
+        cipher = chi_io.CHI_cipher(self.password)
+        chi_io.clear_key_cache()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            new_cipher = pickle.loads(pickle.dumps(cipher, protocol))
+            self.assertTrue(isinstance(new_cipher, chi_io.TheBlowfishClass))
+            result_data = chi_io.PEP272LikeCipher(new_cipher).decrypt(self.binary_data)
+            self.assertEqual(self.plain_text_data, result_data)
+
+    def test_pyblowfish_key_state(self):
+        bf = pyblowfish.Blowfish(b'mypassword')
+        key_state = bf.export_key_state()
+        self.assertEqual(pyblowfish.KEY_STATE_SIZE, len(key_state))
+        new_bf = pyblowfish.Blowfish.from_key_state(key_state)
+        test_data = b"this is just a small piece of text, 48 bytes...."
+        self.assertEqual(bf.encrypt_ecb(test_data), new_bf.encrypt_ecb(test_data))
+        self.assertRaises(ValueError, pyblowfish.Blowfish.from_key_state, key_state[:-1])
+
 
 if __name__ == '__main__':
     print(sys.version)